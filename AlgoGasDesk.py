@@ -1,10 +1,106 @@
+import time
+
 import pandas as pd
 import numpy as np
 
-# Load historical gas price data
-data = pd.read_csv('gas_prices.csv')
-data['date'] = pd.to_datetime(data['date'])
-data = data.set_index('date')
+from Instrumentation import profiled, stage
+from PriceStore import read_table
+from RollingStats import StreamingZScore
+
+
+def load_data(path='gas_prices.csv'):
+    """
+    Loads historical gas price data indexed by date from the columnar price store.
+    """
+    return read_table(path, date_column='date')
+
+
+@profiled
+def rolling_zscore(prices, window):
+    """
+    Computes the rolling z-score of a price array in a single pass.
+
+    Parameters:
+        prices (array-like): The price series.
+        window (int): The moving average / standard deviation window.
+
+    Returns:
+        numpy.ndarray: The z-score of each bar, NaN until the window is full.
+    """
+    prices = pd.Series(np.asarray(prices, dtype=float))
+    ma = prices.rolling(window=window).mean()
+    std = prices.rolling(window=window).std()
+    return ((prices - ma) / std).to_numpy()
+
+
+def zscore_signals(z_score, threshold):
+    """
+    Maps z-scores to per-bar signals: 1 for BUY, -1 for SELL and 0 for HOLD.
+    """
+    signals = np.zeros(len(z_score), dtype=np.int8)
+    signals[z_score < -threshold] = 1
+    signals[z_score > threshold] = -1
+    return signals
+
+
+def signal_positions(signals, trade_amount):
+    """
+    Turns per-bar signals into the held position of a long/flat strategy.
+
+    A BUY opens (or keeps) a long position of trade_amount, a SELL closes it and a HOLD carries the previous
+    position forward.
+    """
+    n = len(signals)
+    last_signal = np.where(signals != 0, np.arange(n), -1)
+    np.maximum.accumulate(last_signal, out=last_signal)
+    is_long = (last_signal >= 0) & (signals[np.maximum(last_signal, 0)] == 1)
+    return np.where(is_long, float(trade_amount), 0.0)
+
+
+def mark_to_market(prices, positions, initial_capital):
+    """
+    Marks a position series to market, trading at each bar's price.
+
+    Returns:
+        tuple: The per-bar trade quantities, cash balances and portfolio values.
+    """
+    trades = np.diff(positions, prepend=0.0)
+    cash = initial_capital - np.cumsum(trades * prices)
+    equity = cash + positions * prices
+    return trades, cash, equity
+
+
+class BacktestResult:
+    """
+    The outcome of a vectorized backtest.
+
+    Attributes:
+        signals (pandas Series): The per-bar signal ('BUY', 'SELL' or 'HOLD').
+        positions (pandas Series): The position held at the close of each bar.
+        pnl (pandas Series): The mark-to-market profit and loss of each bar.
+        equity (pandas Series): The portfolio value at the close of each bar.
+        trades (pandas DataFrame): One row per executed trade with its side, amount and price.
+    """
+
+    SIGNAL_NAMES = np.array(['SELL', 'HOLD', 'BUY'])
+
+    def __init__(self, index, prices, signals, positions, initial_capital):
+        trades, cash, equity = mark_to_market(prices, positions, initial_capital)
+        self.signals = pd.Series(self.SIGNAL_NAMES[signals + 1], index=index, name='signal')
+        self.positions = pd.Series(positions, index=index, name='position')
+        self.equity = pd.Series(equity, index=index, name='equity')
+        self.pnl = pd.Series(np.diff(equity, prepend=initial_capital), index=index, name='pnl')
+        traded = np.flatnonzero(trades)
+        self.trades = pd.DataFrame({
+            'side': np.where(trades[traded] > 0, 'BUY', 'SELL'),
+            'amount': np.abs(trades[traded]),
+            'price': prices[traded]
+        }, index=index[traded])
+
+    @property
+    def final_value(self):
+        return self.equity.iloc[-1]
+
 
 # Define the trading strategy
 class GasTradingStrategy:
@@ -35,24 +131,124 @@ class GasTradingStrategy:
         else:
             return 'HOLD', 0
 
-# Create an instance of the trading strategy
-strategy = GasTradingStrategy(data, ma_period=20, threshold=1.5, trade_amount=1000)
+    @profiled
+    def run_backtest(self, initial_capital=10000):
+        """
+        Backtests the strategy over the whole price history in a single vectorized pass.
 
-# Backtest the strategy on historical data
-portfolio_value = 10000
-for i in range(len(data)):
-    signal, amount = strategy.backtest()
-    
-    if signal == 'BUY':
-        portfolio_value -= amount * data.iloc[i]['price']
-        position = amount
-        
-    elif signal == 'SELL':
-        portfolio_value += position * data.iloc[i]['price']
-        position = 0
-        
-    else:
-        pass
-    
-# Print the final portfolio value
-print('Final portfolio value: %.2f USD' % portfolio_value)
+        The z-score is computed once and every bar is traded at its own price, so the cost is linear in the
+        number of bars.
+
+        Parameters:
+            initial_capital (float): The starting portfolio value.
+
+        Returns:
+            BacktestResult: The signals, positions, PnL, equity curve and trade list.
+        """
+        prices = self.data['price'].to_numpy(dtype=float)
+        z_score = rolling_zscore(prices, self.ma_period)
+        signals = zscore_signals(z_score, self.threshold)
+        positions = signal_positions(signals, self.trade_amount)
+        return BacktestResult(self.data.index, prices, signals, positions, initial_capital)
+
+    def signal_at(self, i):
+        """
+        Returns the signal at bar i using only the prices up to and including that bar.
+
+        Parameters:
+            i (int): The position of the bar in the price history (negative values count from the end).
+
+        Returns:
+            tuple: The signal ('BUY', 'SELL' or 'HOLD') and the amount to trade.
+        """
+        prices = self.data['price']
+        n = len(prices)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('bar index out of range')
+        if i + 1 < self.ma_period:
+            return 'HOLD', 0
+        window = prices.iloc[i + 1 - self.ma_period:i + 1].to_numpy(dtype=float)
+        z_score = (window[-1] - window.mean()) / window.std(ddof=1)
+        if z_score < -self.threshold:
+            return 'BUY', self.trade_amount
+        elif z_score > self.threshold:
+            return 'SELL', self.trade_amount
+        else:
+            return 'HOLD', 0
+
+    def stream(self, warmup=True):
+        """
+        Creates a streaming form of the strategy that produces a signal per tick in constant time.
+
+        Parameters:
+            warmup (bool): Whether to prime the rolling window with the most recent prices in the data.
+
+        Returns:
+            StreamingZScore: The stream; call on_tick(ts, price) for each new price.
+        """
+        stream = StreamingZScore(window=self.ma_period, threshold=self.threshold, trade_amount=self.trade_amount)
+        if warmup:
+            for price in self.data['price'].iloc[-self.ma_period:]:
+                stream.update(price)
+        return stream
+
+
+def benchmark(n_bars=2000, ma_period=20, threshold=1.5, trade_amount=1000, seed=0):
+    """
+    Times the vectorized backtest against the original per-row backtest loop on a synthetic random walk.
+
+    Returns:
+        dict: The wall time of each approach in seconds and the speedup.
+    """
+    rng = np.random.default_rng(seed)
+    index = pd.date_range('2020-01-01', periods=n_bars, freq='h')
+    prices = 3.0 + np.cumsum(rng.normal(scale=0.01, size=n_bars))
+    data = pd.DataFrame({'price': prices}, index=index)
+    strategy = GasTradingStrategy(data, ma_period=ma_period, threshold=threshold, trade_amount=trade_amount)
+
+    start = time.perf_counter()
+    portfolio_value = 10000
+    position = 0
+    for i in range(len(data)):
+        signal, amount = strategy.backtest()
+        if signal == 'BUY':
+            portfolio_value -= amount * data.iloc[i]['price']
+            position = amount
+        elif signal == 'SELL':
+            portfolio_value += position * data.iloc[i]['price']
+            position = 0
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    strategy.run_backtest()
+    vectorized_time = time.perf_counter() - start
+
+    return {
+        'n_bars': n_bars,
+        'loop_seconds': loop_time,
+        'vectorized_seconds': vectorized_time,
+        'speedup': loop_time / vectorized_time
+    }
+
+
+def main(path='gas_prices.csv'):
+    # Load historical gas price data
+    with stage('data_load'):
+        data = load_data(path)
+
+    # Create an instance of the trading strategy
+    strategy = GasTradingStrategy(data, ma_period=20, threshold=1.5, trade_amount=1000)
+
+    # Backtest the strategy on historical data
+    with stage('simulation'):
+        result = strategy.run_backtest(initial_capital=10000)
+
+    # Print the final portfolio value
+    print('Final portfolio value: %.2f USD' % result.final_value)
+    return result
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,36 @@
+import numpy as np
 import pandas as pd
-import requests
 from sklearn.linear_model import LinearRegression
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 
-# Load historical gas price data
-data = pd.read_csv('gas_prices.csv')
-data['date'] = pd.to_datetime(data['date'])
-data = data.set_index('date')
+from GasFeeds import live_feeds
+from Instrumentation import profiled, stage
+from PriceStore import read_table
+from RollingStats import StreamingZScore
 
 # Define the trading strategy
 class GasTradingStrategy:
     
-    def __init__(self, data):
+    def __init__(self, data, feeds=None):
         self.data = data
         self.position = 0
+
+        # External weather and pipeline flow feeds, live by default
+        self.feeds = feeds if feeds is not None else live_feeds()
         
         # Initialize machine learning models
         self.regression_model = LinearRegression()
         self.cluster_model = KMeans(n_clusters=2)
+
+        # Streaming z-score leg for live ticks
+        self.zscore_stream = StreamingZScore(window=10, threshold=0.2)
         
+    @profiled
     def backtest(self):
-        # Get weather forecast data
-        city = 'Houston'
-        api_key = '1234567890'
-        weather_url = f'http://api.openweathermap.org/data/2.5/weather?q={city}&appid={api_key}'
-        temp = requests.get(weather_url).json()['main']['temp']
-        
-        # Get pipeline flow data
-        pipeline_url = 'https://api.pipelines.com/v1/flows'
-        flow = requests.get(pipeline_url).json()['flows'][0]['flow']
+        # Get weather forecast and pipeline flow data as of the last bar
+        feed_data = self.feeds.snapshot(self.data.index[-1])
+        temp = feed_data['temp']
+        flow = feed_data['flow']
         
         # Calculate the moving average and standard deviation
         ma = self.data['price'].rolling(window=10).mean()
@@ -71,3 +73,94 @@ class GasTradingStrategy:
             'flow': flow
         }
         return trade_data
+
+    def on_tick(self, ts, price):
+        """
+        Feeds a live tick into the z-score leg of the strategy in constant time.
+
+        Parameters:
+            ts: The timestamp of the tick.
+            price (float): The traded price.
+
+        Returns:
+            float: The z-score of the tick over the last 10 prices, NaN until 10 ticks have been seen.
+        """
+        self.zscore_stream.on_tick(ts, price)
+        return self.zscore_stream.last_z_score
+
+    @profiled
+    def walk_forward(self, refit_every=20, window=None, min_train=20, random_state=0):
+        """
+        Computes the regression trend and cluster of every bar causally, refitting the models on a fixed cadence.
+
+        The bars between two refits are scored with the models fitted on the data up to the first of them, so no
+        bar sees later data. The regression is updated through its sufficient statistics X'X and X'y, adding the
+        rows that entered the training window and removing those that left it, and the clustering is a
+        MiniBatchKMeans whose partial fits warm-start from the previous centroids. The whole walk is linear in
+        the number of bars.
+
+        Parameters:
+            refit_every (int): The number of bars between two refits.
+            window (int): The number of most recent bars the regression is trained on, None for all of them.
+            min_train (int): The number of bars before the first fit.
+            random_state (int): The seed of the clustering.
+
+        Returns:
+            pandas DataFrame: The z-score, trend and cluster of each bar, NaN / -1 before the first fit.
+        """
+        X = self.data[['price', 'volume']].to_numpy(dtype=float)
+        y = self.data['price'].to_numpy(dtype=float)
+        n = len(X)
+        design = np.column_stack([np.ones(n), X])
+        xtx = np.zeros((design.shape[1], design.shape[1]))
+        xty = np.zeros(design.shape[1])
+        trend = np.full(n, np.nan)
+        cluster = np.full(n, -1)
+        cluster_model = MiniBatchKMeans(n_clusters=2, random_state=random_state, n_init=3)
+
+        first = max(min_train, cluster_model.n_clusters) - 1
+        added = dropped = 0
+        for start in range(first, n, refit_every):
+            end = start + 1
+            segment = slice(start, min(start + refit_every, n))
+
+            # Add the rows that entered the training window and remove those that left it
+            xtx += design[added:end].T @ design[added:end]
+            xty += design[added:end].T @ y[added:end]
+            if window is not None and end - window > dropped:
+                xtx -= design[dropped:end - window].T @ design[dropped:end - window]
+                xty -= design[dropped:end - window].T @ y[dropped:end - window]
+                dropped = end - window
+            coef = np.linalg.lstsq(xtx, xty, rcond=None)[0]
+            trend[segment] = design[segment] @ coef
+
+            # Warm-start the clustering from the previous centroids with the new rows
+            cluster_model.partial_fit(X[added:end])
+            cluster[segment] = cluster_model.predict(X[segment])
+            added = end
+
+        self.walk_forward_cluster_model = cluster_model
+        ma = self.data['price'].rolling(window=10).mean()
+        std = self.data['price'].rolling(window=10).std()
+        return pd.DataFrame({
+            'z_score': (self.data['price'] - ma) / std,
+            'trend': trend,
+            'cluster': cluster
+        }, index=self.data.index)
+
+
+def main(path='gas_prices.csv', feeds=None):
+    # Load historical gas price data
+    with stage('data_load'):
+        data = read_table(path, date_column='date')
+
+    # Trade the last bar with the regression, clustering, z-score and feed conditions
+    strategy = GasTradingStrategy(data, feeds=feeds)
+    with stage('simulation'):
+        trade = strategy.backtest()
+    print(trade)
+    return trade
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+"""
+A reproducible benchmark suite for the TradeDesk workloads, on seeded synthetic data.
+
+Each case times one key path: the GasTradingStrategy backtest, the DataAnalyzer clean and analyze, the
+TradingPredictor search, the demand forecast (also on a history too short for its closed-form start), the Monte
+Carlo VaR/ES simulation, the efficient frontier, the storage dispatch and the GasNetwork dispatch. It runs at
+'small', 'medium' and 'large' sizes on data from SyntheticData. A case is timed repeat times (the fastest run
+counts) and then run once more under the Instrumentation profiler, which gives its peak traced allocation and the
+time of its instrumented stages. Each case also returns a value, e.g. the final portfolio value, so a change in
+results is caught along with a change in speed.
+
+Results can be saved as a JSON baseline, and later runs are compared against it: a case is flagged when it is
+slower or allocates more than the baseline by more than a tolerance, or when its value has changed.
+
+    python BenchmarkSuite.py --sizes small medium --save-baseline baseline.json
+    python BenchmarkSuite.py --sizes small medium --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import SyntheticData
+from AlgoGasDesk import GasTradingStrategy
+from CoherentRiskMeasures2 import MonteCarloRiskEngine
+from Covariance import estimate_covariance
+from DataAnalyzer import DataAnalyzer
+from DemandForecast import DemandForecaster
+from EfficientFrontier import efficient_frontier
+from Instrumentation import run
+from PriceStore import read_table
+from StorageDispatch import StorageFacility, dispatch
+from TradingPredictor import TradingPredictor
+
+PARAM_GRID = {'model__n_estimators': [25, 50], 'model__max_depth': [5, 10]}
+# Too few periods for the closed-form start of the demand fit, which then starts from statsmodels' estimates
+SHORT_DEMAND_PERIODS = 12
+
+
+def _backtest(dataset):
+    data = read_table(dataset['paths']['gas_prices'], date_column='date')
+    strategy = GasTradingStrategy(data, ma_period=20, threshold=1.5, trade_amount=1000)
+    return lambda: strategy.run_backtest(initial_capital=10000).final_value, len(data), 'bars'
+
+
+def _analyze(dataset):
+    def analyze():
+        analyzer = DataAnalyzer(dataset['paths']['esg'], 'mytable')
+        analyzer.clean_data()
+        return analyzer.analyze_data()[2].statistic
+    return analyze, dataset['sizes']['n_esg_rows'], 'rows'
+
+
+def _predictor_fit(dataset):
+    def fit():
+        predictor = TradingPredictor(dataset['paths']['trading'], 'trading_table', SyntheticData.NUMERICAL_FEATURES,
+                                     SyntheticData.CATEGORICAL_FEATURES, SyntheticData.TARGET)
+        # Fixed seeds keep the cross-validated RMSE comparable between runs
+        predictor.rf_pipeline.set_params(model__random_state=dataset['seed'])
+        predictor.gb_pipeline.set_params(model__random_state=dataset['seed'])
+        predictor.clean_data()
+        predictor.fit_models(PARAM_GRID, n_jobs=1, concurrent=False)
+        predictor.evaluate_models()
+        return predictor.rf_rmse
+    return fit, dataset['sizes']['n_trading_rows'], 'rows'
+
+
+def _demand(dataset, n_periods=None):
+    data = read_table(dataset['paths']['supply_demand'], date_column=None)[['demand']].iloc[:n_periods]
+    forecaster = DemandForecaster(max_workers=1)
+    return lambda: forecaster.fit(data, warm_start=False).forecast(12)['demand'].iloc[-1], len(data), 'periods'
+
+
+def _demand_short(dataset):
+    return _demand(dataset, SHORT_DEMAND_PERIODS)
+
+
+def _var_es(dataset):
+    sizes = dataset['sizes']
+    returns = SyntheticData.returns_matrix(sizes['n_return_periods'], sizes['n_risk_assets'], seed=dataset['seed'])
+    covariance = np.cov(returns.to_numpy(), rowvar=False) * 252
+    engine = MonteCarloRiskEngine(np.full(sizes['n_risk_assets'], 1e6 / sizes['n_risk_assets']), covariance)
+    return lambda: engine.simulate(sizes['n_scenarios'], seed=dataset['seed'])['es'], sizes['n_scenarios'], \
+        'scenarios'
+
+
+def _frontier(dataset):
+    sizes = dataset['sizes']
+    returns = SyntheticData.returns_matrix(sizes['n_return_periods'], sizes['n_assets'], seed=dataset['seed'])
+    mu, sigma = estimate_covariance(returns)
+    return lambda: efficient_frontier(mu, sigma, n_points=50)['vol'].min(), 50, 'portfolios'
+
+
+def _storage(dataset):
+    sizes = dataset['sizes']
+    n_periods, n_facilities = sizes['storage_periods'], sizes['n_facilities']
+    prices = SyntheticData.storage_prices(n_periods, n_facilities, seed=dataset['seed'])
+    scale = 365.0 / n_periods
+    facilities = [StorageFacility(start_inventory=50.0, capacity=100.0, min_inventory=5.0, end_inventory=50.0,
+                                  max_injection=2.0 * scale, max_withdrawal=3.0 * scale, injection_cost=0.01,
+                                  withdrawal_cost=0.01, injection_ratchet=(3.0 * scale, 0.02 * scale),
+                                  withdrawal_ratchet=(1.0 * scale, 0.03 * scale))
+                  for _ in range(n_facilities)]
+    return lambda: dispatch(facilities, prices).value.sum(), n_periods * n_facilities, 'facility_periods'
+
+
+def _network(dataset):
+    model = SyntheticData.gas_network(*dataset['sizes']['grid'], seed=dataset['seed'])
+    return lambda: model.solve(shortfall_cost=100.0).cost, model.n_edges, 'pipelines'
+
+
+# Each case builds its inputs from a dataset and returns the timed function, the number of items it processes and
+# their unit
+CASES = {
+    'backtest': _backtest,
+    'analyze': _analyze,
+    'predictor_fit': _predictor_fit,
+    'demand': _demand,
+    'demand_short': _demand_short,
+    'var_es': _var_es,
+    'frontier': _frontier,
+    'storage': _storage,
+    'network': _network,
+}
+
+
+def measure(function, repeat=3, memory=True):
+    """
+    Times a function and measures its peak allocation.
+
+    Parameters:
+        function (callable): The function, called without arguments.
+        repeat (int): The number of timed runs; the fastest counts.
+        memory (bool): Whether to run it once more under the profiler for its peak allocation and stages.
+
+    Returns:
+        dict: The seconds of the fastest run, its value, the peak megabytes allocated and the profiled stages.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = function()
+        timings.append(time.perf_counter() - start)
+    peak_mb, stages = np.nan, {}
+    if memory:
+        _, stages = run(function, memory=True)
+        peak_mb = max(values['peak_bytes'] or 0 for values in stages.values()) / 2 ** 20
+    return {'seconds': min(timings), 'value': float(value), 'peak_mb': peak_mb, 'stages': stages}
+
+
+def run_suite(sizes=('small',), cases=None, repeat=3, memory=True, seed=0):
+    """
+    Runs the benchmark cases on the synthetic dataset of each size.
+
+    Parameters:
+        sizes (list of str): The dataset sizes, from SyntheticData.SIZES.
+        cases (list of str): The cases to run, defaults to all of them.
+        repeat (int): The number of timed runs of each case.
+        memory (bool): Whether to measure peak allocations.
+        seed (int): The random seed of the datasets.
+
+    Returns:
+        pandas DataFrame: One row per size and case with its seconds, throughput in items per second, peak
+        megabytes, value and profiled stages.
+    """
+    cases = list(cases or CASES)
+    rows = []
+    for size in sizes:
+        with tempfile.TemporaryDirectory(prefix='tradedesk-bench-') as directory:
+            dataset = {'size': size, 'seed': seed, 'sizes': SyntheticData.SIZES[size],
+                       'paths': SyntheticData.write_dataset(directory, size, seed)}
+            for case in cases:
+                function, n_items, unit = CASES[case](dataset)
+                measured = measure(function, repeat=repeat, memory=memory)
+                rows.append({'size': size, 'case': case, 'items': n_items, 'unit': unit,
+                             'seconds': measured['seconds'], 'throughput': n_items / measured['seconds'],
+                             'peak_mb': measured['peak_mb'], 'value': measured['value'],
+                             'stages': measured['stages']})
+    return pd.DataFrame(rows).set_index(['size', 'case'])
+
+
+def save_baseline(results, path):
+    """
+    Saves suite results as a JSON baseline, with the platform they were measured on.
+    """
+    records = results.drop(columns='stages').reset_index().to_dict(orient='records')
+    document = {'platform': platform.platform(), 'python': platform.python_version(), 'cpu_count': os.cpu_count(),
+                'results': records}
+    with open(path, 'w') as f:
+        json.dump(document, f, indent=2, default=float)
+    return path
+
+
+def load_baseline(path):
+    """
+    Loads a JSON baseline saved by save_baseline.
+
+    Returns:
+        pandas DataFrame: The baseline results indexed by size and case.
+    """
+    with open(path) as f:
+        document = json.load(f)
+    return pd.DataFrame(document['results']).set_index(['size', 'case'])
+
+
+def compare(results, baseline, time_tolerance=0.25, memory_tolerance=0.25, value_rtol=1e-6, min_seconds=0.01):
+    """
+    Compares suite results with a baseline and flags regressions.
+
+    Parameters:
+        results (pandas DataFrame): The results of run_suite.
+        baseline (pandas DataFrame): The baseline, from load_baseline.
+        time_tolerance (float): The relative slowdown allowed before a case is flagged.
+        memory_tolerance (float): The relative growth of the peak allocation allowed before a case is flagged.
+        value_rtol (float): The relative tolerance on the value of each case.
+        min_seconds (float): The absolute slowdown below which a case is never flagged, as timer noise dominates
+            cases this short.
+
+    Returns:
+        pandas DataFrame: The seconds, peak megabytes and values of the cases found in both, their ratios to the
+        baseline, and the slower, bigger, changed and regression flags.
+    """
+    joined = results[['seconds', 'peak_mb', 'value']].join(
+        baseline[['seconds', 'peak_mb', 'value']], how='inner', rsuffix='_baseline')
+    joined['time_ratio'] = joined['seconds'] / joined['seconds_baseline']
+    joined['memory_ratio'] = joined['peak_mb'] / joined['peak_mb_baseline']
+    joined['slower'] = ((joined['time_ratio'] > 1 + time_tolerance) &
+                        (joined['seconds'] - joined['seconds_baseline'] > min_seconds))
+    joined['bigger'] = joined['memory_ratio'] > 1 + memory_tolerance
+    joined['changed'] = ~np.isclose(joined['value'], joined['value_baseline'], rtol=value_rtol, equal_nan=True)
+    joined['regression'] = joined['slower'] | joined['bigger'] | joined['changed']
+    return joined
+
+
+def main(argv=None):
+    """
+    Runs the suite, optionally saving a baseline or comparing with one.
+
+    Returns:
+        pandas DataFrame: The results, or the comparison when a baseline is given. The process exits with status 1
+        when run as a script and a regression is flagged.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the TradeDesk workloads on synthetic data.')
+    parser.add_argument('--sizes', nargs='+', default=['small'], choices=list(SyntheticData.SIZES))
+    parser.add_argument('--cases', nargs='+', default=None, choices=list(CASES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help='do not measure peak allocations')
+    parser.add_argument('--baseline', help='a baseline JSON file to compare with')
+    parser.add_argument('--save-baseline', help='the file to save the results to as a baseline')
+    parser.add_argument('--time-tolerance', type=float, default=0.25)
+    parser.add_argument('--memory-tolerance', type=float, default=0.25)
+    parser.add_argument('--min-seconds', type=float, default=0.01, help='the smallest slowdown flagged')
+    arguments = parser.parse_args(argv)
+
+    results = run_suite(arguments.sizes, arguments.cases, repeat=arguments.repeat, memory=not arguments.no_memory,
+                        seed=arguments.seed)
+    with pd.option_context('display.width', 160, 'display.max_columns', 20):
+        print(results.drop(columns='stages'))
+        if arguments.save_baseline:
+            save_baseline(results, arguments.save_baseline)
+        if arguments.baseline:
+            comparison = compare(results, load_baseline(arguments.baseline), arguments.time_tolerance,
+                                 arguments.memory_tolerance, min_seconds=arguments.min_seconds)
+            print(comparison[['time_ratio', 'memory_ratio', 'slower', 'bigger', 'changed', 'regression']])
+            return comparison
+    return results
+
+
+if __name__ == '__main__':
+    output = main()
+    if 'regression' in output and output['regression'].any():
+        sys.exit(1)
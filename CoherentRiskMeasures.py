@@ -1,32 +1,237 @@
+import math
+import time
+from bisect import bisect_left, bisect_right, insort
+
+import numpy as np
+import pandas as pd
 import scipy.stats as stats
+from numpy.lib.stride_tricks import sliding_window_view
+
+from Instrumentation import profiled, stage
+
+
+def risk_measures(portfolio_returns, level=0.95):
+    """
+    Computes the parametric VaR, the ES and the CVaR of a series of portfolio returns.
+
+    Parameters:
+        portfolio_returns (array-like): The portfolio returns.
+        level (float): The confidence level.
+
+    Returns:
+        tuple: The VaR, ES and CVaR.
+    """
+    portfolio_returns = np.asarray(portfolio_returns, dtype=float)
+
+    # Calculate the VaR
+    var = stats.norm.ppf(1 - level, loc=portfolio_returns.mean(), scale=portfolio_returns.std())
+
+    # Define threshold once and split the returns around it
+    threshold = np.percentile(portfolio_returns, 100 * (1 - level))
+    in_tail = portfolio_returns <= threshold
+
+    # Calculate the ES and CVaR
+    es = portfolio_returns[in_tail].mean()
+    cvar = es + 0.5 * portfolio_returns[~in_tail].mean()
+    return var, es, cvar
+
+
+def _percentile_position(window, level):
+    """
+    The index and interpolation weight of the (1 - level) percentile of a window, as used by np.percentile.
+    """
+    h = (window - 1) * (1 - level)
+    lower = int(math.floor(h))
+    return lower, h - lower
+
+
+def _rolling_parametric_var(returns, window, level):
+    """
+    Rolling normal VaR of every column, from cumulative sums of the returns and their squares.
+    """
+    # Centre each column on its first value to limit cancellation in the sums of squares
+    centred = returns - returns[:1]
+    zeros = np.zeros((1, returns.shape[1]))
+    sums = np.concatenate([zeros, np.cumsum(centred, axis=0)])
+    squares = np.concatenate([zeros, np.cumsum(centred ** 2, axis=0)])
+    window_sums = sums[window:] - sums[:-window]
+    window_squares = squares[window:] - squares[:-window]
+    mean = window_sums / window
+    std = np.sqrt(np.maximum(window_squares / window - mean ** 2, 0.0))
+    var = np.full(returns.shape, np.nan)
+    var[window - 1:] = mean + returns[:1] + stats.norm.ppf(1 - level) * std
+    return var
+
+
+def _rolling_tail_sorted(column, window, level):
+    """
+    Rolling historical VaR and ES of one column from a sorted window.
+
+    The window is kept sorted: each step removes the value leaving it and inserts the new one by binary search,
+    and the sum of the lowest values is updated from the values crossing the percentile position rather than
+    re-summed. Values are re-summed exactly once per window length to stop rounding errors from accumulating.
+    """
+    n = len(column)
+    var = np.full(n, np.nan)
+    es = np.full(n, np.nan)
+    if n < window:
+        return var, es
+    lower, weight = _percentile_position(window, level)
+    k = lower + 1
+    values = column.tolist()
+    ordered = sorted(values[:window])
+    low_sum = math.fsum(ordered[:k])
+    for t in range(window - 1, n):
+        if t >= window:
+            old, new = values[t - window], values[t]
+            i = bisect_left(ordered, old)
+            del ordered[i]
+            if i < k:
+                low_sum += ordered[k - 1] - old
+            i = bisect_right(ordered, new)
+            insort(ordered, new)
+            if i < k:
+                low_sum += new - ordered[k]
+            if (t - window + 1) % window == 0:
+                low_sum = math.fsum(ordered[:k])
+        below, above = ordered[lower], ordered[min(lower + 1, window - 1)]
+        threshold = below + weight * (above - below)
+        total, count = low_sum, k
+        # Values tied with the threshold past the percentile position
+        j = k
+        while j < window and ordered[j] <= threshold:
+            total += ordered[j]
+            count += 1
+            j += 1
+        var[t] = threshold
+        es[t] = total / count
+    return var, es
+
+
+def _rolling_tail_partition(returns, window, level, max_bytes=2 ** 26):
+    """
+    Rolling historical VaR and ES of every column by partitioning blocks of windows at once.
+
+    Each block holds a partitioned copy of its windows and a mask over it, about 9 bytes per value, so the block
+    length is chosen to keep those within max_bytes whatever the window length and number of columns.
+    """
+    n, n_columns = returns.shape
+    var = np.full(returns.shape, np.nan)
+    es = np.full(returns.shape, np.nan)
+    lower, weight = _percentile_position(window, level)
+    upper = min(lower + 1, window - 1)
+    block = max(1, max_bytes // (9 * window * n_columns))
+    for start in range(window - 1, n, block):
+        end = min(start + block, n)
+        windows = sliding_window_view(returns[start - window + 1:end], window, axis=0)
+        partitioned = np.partition(windows, sorted({lower, upper}), axis=-1)
+        below, above = partitioned[..., lower], partitioned[..., upper]
+        threshold = below + weight * (above - below)
+        # Zero the values above the threshold in the copy, then sum what is left
+        outside = partitioned > threshold[..., None]
+        count = window - outside.sum(axis=-1)
+        partitioned[outside] = 0.0
+        var[start:end] = threshold
+        es[start:end] = partitioned.sum(axis=-1) / count
+    return var, es
+
+
+@profiled
+def rolling_risk(returns, window, level=0.95, method='sorted'):
+    """
+    Computes rolling parametric VaR, historical VaR and ES for every portfolio in a returns matrix.
+
+    The parametric VaR uses rolling means and standard deviations from cumulative sums, in O(1) per step. The
+    historical VaR is the (1 - level) percentile of the window, interpolated like np.percentile, and the ES is the
+    mean of the window returns at or below it.
+
+    Parameters:
+        returns (array-like or pandas DataFrame): The returns, one row per period and one column per portfolio.
+        window (int): The number of periods in each window.
+        level (float): The confidence level.
+        method (str): 'sorted' keeps each column's window sorted and updates it by binary search, costing
+            O(log window) comparisons per step; 'partition' partitions blocks of windows of all columns at once,
+            O(window) per step but vectorized, which is faster for short windows.
+
+    Returns:
+        dict: The 'parametric_var', 'historical_var' and 'es' arrays (DataFrames for DataFrame input), NaN for the
+        first window - 1 periods.
+    """
+    frame = returns if isinstance(returns, pd.DataFrame) else None
+    returns = np.asarray(returns, dtype=float)
+    if returns.ndim == 1:
+        returns = returns[:, None]
+    if window < 2:
+        raise ValueError('window must be at least 2')
 
-# Define portfolio returns
-portfolio_returns = [-0.02, 0.01, -0.03, 0.02, 0.005, -0.01, 0.02, -0.01, 0.015, 0.02]
+    results = {'parametric_var': _rolling_parametric_var(returns, window, level)}
+    if method == 'sorted':
+        tails = [_rolling_tail_sorted(returns[:, j], window, level) for j in range(returns.shape[1])]
+        results['historical_var'] = np.column_stack([tail[0] for tail in tails])
+        results['es'] = np.column_stack([tail[1] for tail in tails])
+    elif method == 'partition':
+        results['historical_var'], results['es'] = _rolling_tail_partition(returns, window, level)
+    else:
+        raise ValueError(f"method must be 'sorted' or 'partition', got {method!r}")
 
-# Calculate the 95% VaR
-var_95 = stats.norm.ppf(0.05, loc=np.mean(portfolio_returns), scale=np.std(portfolio_returns))
+    if frame is not None:
+        results = {name: pd.DataFrame(values, index=frame.index, columns=frame.columns)
+                   for name, values in results.items()}
+    return results
 
-# Print the VaR
-print(f"The 95% VaR is {var_95:.3f}")
 
+def naive_rolling_risk(returns, window, level=0.95):
+    """
+    The per-window reference implementation of rolling_risk: every window is measured from scratch.
+    """
+    returns = np.asarray(returns, dtype=float)
+    if returns.ndim == 1:
+        returns = returns[:, None]
+    results = {name: np.full(returns.shape, np.nan) for name in ('parametric_var', 'historical_var', 'es')}
+    for t in range(window - 1, len(returns)):
+        for j in range(returns.shape[1]):
+            values = returns[t - window + 1:t + 1, j]
+            threshold = np.percentile(values, 100 * (1 - level))
+            results['parametric_var'][t, j] = stats.norm.ppf(1 - level, loc=values.mean(), scale=values.std())
+            results['historical_var'][t, j] = threshold
+            results['es'][t, j] = values[values <= threshold].mean()
+    return results
 
 
-# Define threshold
-threshold = np.percentile(portfolio_returns, 5)
+def benchmark(n_periods=20000, n_portfolios=10, window=1000, level=0.95, seed=0):
+    """
+    Times rolling_risk with both methods against the naive per-window approach on random returns.
 
-# Calculate the ES
-es = np.mean([loss for loss in portfolio_returns if loss <= threshold])
+    Returns:
+        dict: The wall time of each approach in seconds.
+    """
+    rng = np.random.default_rng(seed)
+    returns = rng.standard_t(4, size=(n_periods, n_portfolios)) * 0.01
+    timings = {}
+    for method in ('sorted', 'partition'):
+        start = time.perf_counter()
+        rolling_risk(returns, window, level, method=method)
+        timings[method] = time.perf_counter() - start
+    start = time.perf_counter()
+    naive_rolling_risk(returns, window, level)
+    timings['naive'] = time.perf_counter() - start
+    return timings
 
-# Print the ES
-print(f"The ES is {es:.3f}")
 
+def main():
+    # Define portfolio returns
+    portfolio_returns = [-0.02, 0.01, -0.03, 0.02, 0.005, -0.01, 0.02, -0.01, 0.015, 0.02]
 
-# Define threshold
-threshold = np.percentile(portfolio_returns, 5)
+    # Calculate the 95% VaR, the ES and the CVaR
+    with stage('risk_measures'):
+        var_95, es, cvar = risk_measures(portfolio_returns, level=0.95)
 
-# Calculate the CVaR
-cvar = np.mean([loss for loss in portfolio_returns if loss <= threshold]) + 0.5 * np.mean([loss for loss in portfolio_returns if loss > threshold])
+    # Print the results
+    print(f"The 95% VaR is {var_95:.3f}")
+    print(f"The ES is {es:.3f}")
+    print(f"The CVaR is {cvar:.3f}")
+    return var_95, es, cvar
 
-# Print the CVaR
-print(f"The CVaR is {cvar:.3f}")
 
+if __name__ == '__main__':
+    main()
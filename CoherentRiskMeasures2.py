@@ -1,29 +1,438 @@
+import math
+import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import scipy.stats as stats
+from scipy.stats import qmc
+
+from Instrumentation import profiled, stage
+
+METHODS = ('plain', 'antithetic', 'sobol', 'control', 'importance')
+
+
+def _sorted_tail(values, weights=None, k=1, mass=None):
+    """
+    The k smallest values in sorted order, with their weights; given a mass, the smallest values whose weights add
+    up to at least mass, searched from the k smallest upwards.
+
+    Only the selected values are sorted, after a partial selection of the whole array.
+    """
+    n = len(values)
+    while True:
+        k = min(max(k, 1), n)
+        index = np.argpartition(values, k - 1)[:k] if k < n else np.arange(n)
+        index = index[np.argsort(values[index])]
+        if mass is None:
+            return values[index], None if weights is None else weights[index]
+        cumulative = np.cumsum(weights[index])
+        if cumulative[-1] >= mass or k == n:
+            index = index[:np.searchsorted(cumulative, mass) + 1]
+            return values[index], weights[index]
+        k *= 2
+
+
+class TailBuffer:
+    """
+    Keeps the smallest values seen in a stream, in O(tail + chunk) memory.
+
+    Unweighted buffers keep the k smallest values. Weighted buffers (importance sampling) keep, in sorted order,
+    the smallest values whose weights add up to at least mass.
+    """
+
+    def __init__(self, k=None, mass=None):
+        self.k = k
+        self.mass = mass
+        self.values = np.empty(0)
+        self.weights = None if mass is None else np.empty(0)
+
+    def add(self, values, weights=None):
+        values = np.concatenate([self.values, np.asarray(values, dtype=float)])
+        if self.mass is None:
+            if len(values) > self.k:
+                # Partial selection instead of a full sort
+                values = np.partition(values, self.k - 1)[:self.k]
+            self.values = values
+            return
+        weights = np.concatenate([self.weights, weights])
+        self.values, self.weights = _sorted_tail(values, weights, max(2 * len(self.values), 1024), self.mass)
+
+    def merge(self, other):
+        self.add(other.values, other.weights)
+
+    def sorted(self):
+        """
+        The values and weights kept, in sorted order.
+        """
+        if self.mass is not None:
+            return self.values, self.weights
+        return np.sort(self.values), None
+
+
+def _tail_count(n, level):
+    """
+    The number of worst scenarios beyond a confidence level, ignoring rounding noise in n * (1 - level).
+    """
+    return max(1, math.ceil(round(n * (1 - level), 9)))
+
+
+def _quantile_from_tail(worst, n, q):
+    """
+    The q quantile of n values, interpolated like np.percentile, from the sorted smallest values.
+    """
+    h = (n - 1) * q
+    lo = int(math.floor(h))
+    hi = min(lo + 1, n - 1)
+    return worst[lo] + (h - lo) * (worst[hi] - worst[lo])
+
+
+def _tail_estimates(worst, n, var_level, es_level, weights=None):
+    """
+    VaR and ES from the sorted smallest values of a sample of n scenarios, optionally weighted.
+
+    Weighted scenarios have probability weight / n. The likelihood ratios have expectation one, so this is
+    unbiased, unlike normalizing by their realized sum, which also gives up most of the variance reduction.
+    """
+    if weights is None:
+        return _quantile_from_tail(worst, n, 1 - var_level), worst[:_tail_count(n, es_level)].mean()
+    cumulative = np.cumsum(weights)
+    var_index = min(np.searchsorted(cumulative, n * (1 - var_level)), len(worst) - 1)
+    mass = n * (1 - es_level)
+    last = min(np.searchsorted(cumulative, mass), len(worst) - 1)
+    below = cumulative[last - 1] if last > 0 else 0.0
+    es = (np.dot(weights[:last], worst[:last]) + (mass - below) * worst[last]) / mass
+    return worst[var_index], es
+
+
+def _normals(rng, method, n, dimension, shift):
+    """
+    Draws the standard normal scenarios of one chunk and their likelihood ratios (None when unweighted).
+    """
+    if method == 'antithetic':
+        half = rng.standard_normal((-(-n // 2), dimension))
+        return np.concatenate([half, -half])[:n], None
+    if method == 'sobol':
+        # Each chunk is an independent scramble, so batches remain independent replicates
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            uniforms = qmc.Sobol(dimension, scramble=True, seed=rng).random(n)
+        return stats.norm.ppf(np.clip(uniforms, 1e-12, 1 - 1e-12)), None
+    normals = rng.standard_normal((n, dimension))
+    if method == 'importance':
+        # Sample from N(shift, I) and weight by the likelihood ratio back to N(0, I)
+        normals += shift
+        return normals, np.exp(0.5 * np.dot(shift, shift) - normals @ shift)
+    return normals, None
+
+
+def _tail_buffers(n, level, weighted):
+    """
+    A buffer large enough for the VaR and ES of n scenarios at the lower of the two levels.
+    """
+    if weighted:
+        return TailBuffer(mass=n * (1 - level))
+    return TailBuffer(min(n, _tail_count(n, level) + 2))
+
+
+def _simulate_batches(task):
+    """
+    Simulates a list of scenario batches and returns their tails, moments and per-batch estimates.
+    """
+    spec, batches, n_scenarios, var_level, es_level = task
+    cpu_start = time.process_time()
+    position_values, drift, cholesky = spec['position_values'], spec['drift'], spec['cholesky']
+    method = spec['method']
+    weighted = method == 'importance'
+    level = min(var_level, es_level)
+    tail = _tail_buffers(n_scenarios, level, weighted)
+    control_tail = _tail_buffers(n_scenarios, level, False) if method == 'control' else None
+    count, total, total_sq = 0, 0.0, 0.0
+    batch_estimates = []
+    for chunks in batches:
+        # The tails of this batch alone, for batch-means standard errors
+        batch_size = sum(n for _, n in chunks)
+        batch_tail = _tail_buffers(batch_size, level, weighted)
+        batch_control_tail = _tail_buffers(batch_size, level, False) if control_tail is not None else None
+        for seed, n in chunks:
+            rng = np.random.default_rng(seed)
+            normals, weights = _normals(rng, method, n, len(position_values), spec['shift'])
+            log_returns = drift + normals @ cholesky.T
+            pnl = np.expm1(log_returns) @ position_values
+            tail.add(pnl, weights)
+            batch_tail.add(pnl, weights)
+            count += n
+            if weights is None:
+                total += pnl.sum()
+                total_sq += np.dot(pnl, pnl)
+            else:
+                total += np.dot(weights, pnl)
+                total_sq += np.dot(weights, pnl * pnl)
+            if control_tail is not None:
+                # Linearized P&L, whose Gaussian VaR and ES are known in closed form
+                linear = log_returns @ position_values
+                control_tail.add(linear)
+                batch_control_tail.add(linear)
+
+        worst, weights = batch_tail.sorted()
+        estimate = _tail_estimates(worst, batch_size, var_level, es_level, weights)
+        if control_tail is not None:
+            estimate += _tail_estimates(batch_control_tail.sorted()[0], batch_size, var_level, es_level)
+        batch_estimates.append(estimate)
+    cpu_seconds = time.process_time() - cpu_start
+    return tail, control_tail, count, total, total_sq, batch_estimates, cpu_seconds
+
+
+def _apply_control(batch_estimates, true_var, true_es):
+    """
+    Applies the control variate to the per-batch VaR and ES, with coefficients fitted across batches.
+
+    Returns:
+        tuple: The corrected per-batch estimates and the coefficients of VaR and ES.
+    """
+    corrected = batch_estimates[:, :2].copy()
+    betas = []
+    for j, true_value in enumerate((true_var, true_es)):
+        target, control = batch_estimates[:, j], batch_estimates[:, j + 2]
+        variance = control.var(ddof=1) if len(control) > 1 else 0.0
+        beta = np.cov(target, control)[0, 1] / variance if variance > 0 else 1.0
+        betas.append(beta)
+        corrected[:, j] = target - beta * (control - true_value)
+    return corrected, betas
+
+
+class MonteCarloRiskEngine:
+    """
+    Monte Carlo VaR and ES of a portfolio of positions with jointly normal log returns.
+
+    Scenarios are split into a fixed number of independent batches, generated in chunks of bounded size, each
+    from its own random stream spawned from a single SeedSequence, so results are reproducible whatever the number
+    of worker processes. Only the smallest P&Ls needed for the tail estimates are kept, so memory stays bounded by
+    the chunk size and the tail size rather than the number of scenarios.
+
+    Variance reduction methods:
+        plain: independent normal scenarios.
+        antithetic: each chunk pairs every normal draw z with -z.
+        sobol: scrambled Sobol points mapped to normals (randomized quasi-Monte Carlo).
+        control: the linearized P&L, whose Gaussian VaR and ES are known analytically, is used as a control
+            variate with a coefficient estimated from the batches.
+        importance: normals are shifted towards the portfolio's loss direction and reweighted by their
+            likelihood ratio, so more scenarios land in the tail.
+
+    Standard errors are batch means over the batches (each batch is an independent replicate), whose number does
+    not depend on the chunk size.
+    """
+
+    def __init__(self, position_values, covariance, mean_returns=None, horizon=1.0, chunk_size=None, n_batches=20):
+        """
+        Parameters:
+            position_values (array-like): The value of each position.
+            covariance (array-like): The annual covariance matrix of the log returns.
+            mean_returns (array-like): The annual expected log returns, defaults to -0.5 * variance (zero expected
+                arithmetic return).
+            horizon (float): The risk horizon in years.
+            chunk_size (int): The largest number of scenarios per chunk, defaults to about 4 million random numbers.
+            n_batches (int): The number of batches the standard errors are estimated from.
+        """
+        self.position_values = np.asarray(position_values, dtype=float)
+        covariance = np.asarray(covariance, dtype=float)
+        n_assets = len(self.position_values)
+        if covariance.shape != (n_assets, n_assets):
+            raise ValueError('covariance must be a square matrix matching the number of positions')
+        if mean_returns is None:
+            mean_returns = -0.5 * np.diag(covariance)
+        self.drift = np.asarray(mean_returns, dtype=float) * horizon
+        self.cholesky = np.linalg.cholesky(covariance * horizon)
+        self.chunk_size = chunk_size or max(1024, 2 ** 22 // n_assets)
+        self.n_batches = n_batches
+
+    def _batches(self, n_scenarios, seed, method):
+        """
+        Splits the scenarios into batches of nearly equal size, each a list of (seed, size) chunks.
+        """
+        chunk_size = self.chunk_size
+        if method == 'sobol':
+            # Sobol points are balanced in blocks of powers of two
+            chunk_size = 2 ** int(math.log2(chunk_size))
+        n_batches = min(self.n_batches, n_scenarios)
+        bounds = np.linspace(0, n_scenarios, n_batches + 1).round().astype(int)
+        batches = []
+        for batch_seed, batch_size in zip(np.random.SeedSequence(seed).spawn(n_batches), np.diff(bounds).tolist()):
+            n_chunks = -(-batch_size // chunk_size)
+            sizes = [chunk_size] * (n_chunks - 1) + [batch_size - chunk_size * (n_chunks - 1)]
+            batches.append(list(zip(batch_seed.spawn(n_chunks), sizes)))
+        return batches
+
+    def _linear_moments(self):
+        """
+        Mean and standard deviation of the linearized P&L, position_values . log_returns.
+        """
+        return self.position_values @ self.drift, np.linalg.norm(self.cholesky.T @ self.position_values)
+
+    def importance_shift(self, level=0.975):
+        """
+        The mean shift of the normals that centres the linearized P&L on its (1 - level) quantile.
+        """
+        gradient = self.cholesky.T @ self.position_values
+        return -gradient / np.linalg.norm(gradient) * stats.norm.ppf(level)
+
+    @profiled
+    def simulate(self, n_scenarios, var_level=0.95, es_level=0.975, seed=None, max_workers=1, method='plain'):
+        """
+        Simulates the portfolio P&L and estimates its VaR and ES.
+
+        VaR and ES are reported as P&L figures, so losses are negative: VaR is the (1 - var_level) quantile of the
+        P&L and ES is the mean of the worst (1 - es_level) share of scenarios.
+
+        Parameters:
+            n_scenarios (int): The number of scenarios.
+            var_level (float): The VaR confidence level.
+            es_level (float): The ES confidence level.
+            seed (int): The root seed of the random streams.
+            max_workers (int): The number of worker processes; 1 simulates in the calling process, None uses all
+                CPUs.
+            method (str): The variance reduction method, one of METHODS.
+
+        Returns:
+            dict: The VaR, ES, mean and standard deviation of the P&L, the standard errors of VaR and ES, the
+            number of scenarios and batches, the wall and CPU time, and the ES standard error scaled to one CPU
+            second (se_es * sqrt(cpu_seconds), lower is more efficient).
+        """
+        if method not in METHODS:
+            raise ValueError(f'method must be one of {METHODS}, got {method!r}')
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        shift = self.importance_shift(es_level) if method == 'importance' else None
+        level = min(var_level, es_level)
+        spec = {'position_values': self.position_values, 'drift': self.drift, 'cholesky': self.cholesky,
+                'method': method, 'shift': shift}
+        batches = self._batches(n_scenarios, seed, method)
+        max_workers = max_workers or os.cpu_count() or 1
+        tasks = [(spec, batches[i::max_workers], n_scenarios, var_level, es_level)
+                 for i in range(min(max_workers, len(batches)))]
+        if max_workers == 1:
+            results = [_simulate_batches(task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(_simulate_batches, tasks))
+
+        tail = _tail_buffers(n_scenarios, level, method == 'importance')
+        control_tail = _tail_buffers(n_scenarios, level, False)
+        count, total, total_sq, worker_cpu = 0, 0.0, 0.0, 0.0
+        batch_estimates = []
+        for result in results:
+            tail.merge(result[0])
+            if result[1] is not None:
+                control_tail.merge(result[1])
+            count += result[2]
+            total += result[3]
+            total_sq += result[4]
+            batch_estimates.extend(result[5])
+            worker_cpu += result[6]
+
+        worst, weights = tail.sorted()
+        var, es = _tail_estimates(worst, count, var_level, es_level, weights)
+        batch_estimates = np.array(batch_estimates)
+        if method == 'control':
+            # Correct the estimates by the error of the control, whose true VaR and ES are analytic
+            linear_mean, linear_std = self._linear_moments()
+            true_var = stats.norm.ppf(1 - var_level, loc=linear_mean, scale=linear_std)
+            true_es = linear_mean - linear_std * stats.norm.pdf(stats.norm.ppf(es_level)) / (1 - es_level)
+            control_var, control_es = _tail_estimates(control_tail.sorted()[0], count, var_level, es_level)
+            batch_estimates, (beta_var, beta_es) = _apply_control(batch_estimates, true_var, true_es)
+            var -= beta_var * (control_var - true_var)
+            es -= beta_es * (control_es - true_es)
+
+        n_batches = len(batch_estimates)
+        if n_batches > 1:
+            se_var, se_es = batch_estimates[:, :2].std(axis=0, ddof=1) / math.sqrt(n_batches)
+        else:
+            se_var = se_es = math.nan
+        mean = total / count
+        cpu_seconds = time.process_time() - cpu_start + (worker_cpu if max_workers > 1 else 0.0)
+        return {
+            'var': var,
+            'es': es,
+            'mean': mean,
+            'std': math.sqrt(max(total_sq / count - mean ** 2, 0.0) * count / max(count - 1, 1)),
+            'se_var': se_var,
+            'se_es': se_es,
+            'n_scenarios': count,
+            'n_batches': n_batches,
+            'seconds': time.perf_counter() - start,
+            'cpu_seconds': cpu_seconds,
+            'se_es_per_cpu_second': se_es * math.sqrt(cpu_seconds)
+        }
+
+    def parametric_var(self, var_level=0.95):
+        """
+        The delta-normal VaR of the portfolio, as a P&L figure.
+        """
+        mean, std = self._linear_moments()
+        return stats.norm.ppf(1 - var_level, loc=mean, scale=std)
+
+    def compare_methods(self, n_scenarios, var_level=0.95, es_level=0.975, seed=None, max_workers=1,
+                        methods=METHODS):
+        """
+        Runs every variance reduction method on the same number of scenarios.
+
+        Returns:
+            dict: The result of simulate for each method, with its variance reduction (the ratio of the plain ES
+            variance to its own) and its efficiency gain (the same ratio per CPU second).
+        """
+        results = {method: self.simulate(n_scenarios, var_level=var_level, es_level=es_level, seed=seed,
+                                         max_workers=max_workers, method=method)
+                   for method in dict.fromkeys(('plain',) + tuple(methods))}
+        plain = results['plain']
+        for result in results.values():
+            result['variance_reduction'] = (plain['se_es'] / result['se_es']) ** 2
+            result['efficiency_gain'] = (plain['se_es_per_cpu_second'] / result['se_es_per_cpu_second']) ** 2
+        return {method: results[method] for method in methods}
+
+
+def benchmark(n_assets=200, n_scenarios=1000000, worker_counts=(1, 2, 4), seed=0):
+    """
+    Times the engine on a random portfolio for several worker counts.
+
+    Returns:
+        list of dict: The worker count, wall time and scenarios per second of each run.
+    """
+    rng = np.random.default_rng(seed)
+    factors = rng.normal(scale=0.1, size=(n_assets, 5))
+    covariance = factors @ factors.T + np.diag(rng.uniform(0.01, 0.04, n_assets))
+    engine = MonteCarloRiskEngine(rng.uniform(1e4, 1e5, n_assets), covariance, horizon=1 / 252)
+    timings = []
+    for workers in worker_counts:
+        result = engine.simulate(n_scenarios, seed=seed, max_workers=workers)
+        timings.append({'workers': workers, 'seconds': result['seconds'],
+                        'scenarios_per_second': n_scenarios / result['seconds']})
+    return timings
+
+
+def main():
+    # Define portfolio characteristics
+    asset_values = np.array([500000, 500000])
+    correlation_matrix = np.array([[1, 0.8], [0.8, 1]])
+    volatility_matrix = np.array([[0.2, 0.1], [0.1, 0.15]])
+    time_horizon = 1  # in years
+    num_simulations = 10000
+
+    # Define VaR and ES confidence levels
+    var_confidence_level = 0.95
+    es_confidence_level = 0.975
+
+    # Simulate future returns and calculate VaR and ES
+    covariance = correlation_matrix.dot(volatility_matrix).dot(correlation_matrix)
+    engine = MonteCarloRiskEngine(asset_values, covariance, horizon=time_horizon)
+    with stage('simulation'):
+        result = engine.simulate(num_simulations, var_level=var_confidence_level, es_level=es_confidence_level)
+
+    # Print results
+    print(f"The 95% VaR is {result['var']:.2f}")
+    print(f"The 97.5% ES is {result['es']:.2f}")
+    return result
+
 
-# Define portfolio characteristics
-portfolio_value = 1000000
-asset_values = np.array([500000, 500000])
-correlation_matrix = np.array([[1, 0.8], [0.8, 1]])
-volatility_matrix = np.array([[0.2, 0.1], [0.1, 0.15]])
-time_horizon = 1  # in years
-num_simulations = 10000
-
-# Define VaR and ES confidence levels
-var_confidence_level = 0.95
-es_confidence_level = 0.975
-
-# Simulate future returns
-mean_returns = np.log(asset_values) - 0.5 * np.diag(volatility_matrix) ** 2
-cholesky_decomposition = np.linalg.cholesky(correlation_matrix.dot(volatility_matrix).dot(correlation_matrix))
-normal_returns = np.random.normal(size=(num_simulations, 2))
-log_returns = mean_returns + cholesky_decomposition.dot(normal_returns.T).T
-portfolio_returns = portfolio_value * np.sum(np.exp(log_returns) - 1, axis=1)
-
-# Calculate VaR and ES
-var_95 = np.percentile(portfolio_returns, 100 * (1 - var_confidence_level))
-es_975 = np.mean(np.sort(portfolio_returns)[:int(num_simulations * es_confidence_level)])
-
-# Print results
-print(f"The 95% VaR is {var_95:.2f}")
-print(f"The 97.5% ES is {es_975:.2f}")
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,129 @@
-import pandas as pd
+import math
 import sqlite3
+from collections import namedtuple
+
+import pandas as pd
 import matplotlib.pyplot as plt
 from scipy import stats
 
+from Instrumentation import profiled, stage
+
+StreamingTtestResult = namedtuple('StreamingTtestResult', ['statistic', 'pvalue', 'df'])
+
+
+def _to_number(value):
+    """
+    SQLite function converting a text value to a number the way pd.to_numeric(errors='coerce') does.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class RunningStats:
+    """
+    Count, mean and sum of squared deviations (M2) of a stream of values, merged chunk by chunk.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.has_nan = False
+
+    def update(self, values):
+        """
+        Merges a chunk of values using Chan's parallel update of the mean and M2.
+        """
+        if values.isna().any():
+            self.has_nan = True
+            values = values.dropna()
+        n = len(values)
+        if n == 0:
+            return
+        mean = values.mean()
+        m2 = ((values - mean) ** 2).sum()
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.count * n / total
+        self.count = total
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else math.nan
+
+
 class DataAnalyzer:
     """
     A class that performs data analysis on ESG and non-ESG performance data retrieved from an SQL database.
     """
     
-    def __init__(self, database_name, table_name):
+    def __init__(self, database_name, table_name, load=True):
         """
         Initializes a new DataAnalyzer object with the specified database name and table name.
         
         Args:
         - database_name (str): the name of the SQL database to connect to
         - table_name (str): the name of the table in the database to retrieve data from
+        - load (bool): whether to load the whole table into memory; use False with stream_analyze on tables that
+          do not fit in memory
         """
         self.conn = sqlite3.connect(database_name)
+        self.conn.create_function('to_number', 1, _to_number, deterministic=True)
         self.table_name = table_name
-        self.df = self.retrieve_data()
+        self.columns = self._table_columns()
+        self.df = self.retrieve_data() if load else None
+
+    def _table_columns(self):
+        """
+        Checks that the table exists and returns the names of its columns.
+        """
+        exists = self.conn.execute("SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?",
+                                   (self.table_name,)).fetchone()
+        if exists is None:
+            raise ValueError(f'no table named {self.table_name!r} in the database')
+        return [row[1] for row in self.conn.execute(f'PRAGMA table_info({self._quote(self.table_name)})')]
+
+    @staticmethod
+    def _quote(identifier):
+        # Table and column names cannot be bound as query parameters, so they are validated and quoted instead
+        return '"' + identifier.replace('"', '""') + '"'
     
-    def retrieve_data(self):
+    @profiled
+    def retrieve_data(self, columns=None, chunksize=None):
         """
         Retrieves data from the SQL database and returns it as a pandas DataFrame.
         
+        Args:
+        - columns (list of str): the columns to retrieve, all of them by default
+        - chunksize (int): if given, the number of rows per DataFrame of an iterator over the table
+        
         Returns:
-        - df (pandas DataFrame): the DataFrame containing the retrieved data
+        - df (pandas DataFrame): the DataFrame containing the retrieved data, or an iterator of DataFrames when
+          chunksize is given
         """
-        query = f"SELECT * FROM {self.table_name}"
-        return pd.read_sql_query(query, self.conn)
+        columns = columns or self.columns
+        unknown = set(columns) - set(self.columns)
+        if unknown:
+            raise ValueError(f'unknown columns {sorted(unknown)} in table {self.table_name!r}')
+        query = f"SELECT {', '.join(map(self._quote, columns))} FROM {self._quote(self.table_name)}"
+        return pd.read_sql_query(query, self.conn, chunksize=chunksize)
+
+    def create_indexes(self):
+        """
+        Creates the index used by the queries of stream_analyze: (performance_type, time) followed by every other
+        column, so it covers the rows de-duplicated by clean_data. SQLite then reads each performance type with an
+        ordered scan of the index and drops duplicates as it goes, without a table lookup or a temporary B-tree.
+        """
+        index_name = self._quote(f'idx_{self.table_name}_performance_type_time_covering')
+        others = [column for column in self.columns if column not in ('performance_type', 'time')]
+        columns = ', '.join(map(self._quote, ['performance_type', 'time'] + others))
+        self.conn.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {self._quote(self.table_name)} ({columns})')
+        self.conn.commit()
     
+    @profiled
     def clean_data(self):
         """
         Cleans the data by dropping rows with missing values, dropping duplicate rows, and converting the performance
@@ -37,8 +131,11 @@ class DataAnalyzer:
         """
         self.df = self.df.dropna() # Drop rows with missing values
         self.df = self.df.drop_duplicates() # Drop duplicate rows
-        self.df['performance_value'] = pd.to_numeric(self.df['performance_value'], errors='coerce') # Convert to numeric
+        if 'performance_value' in self.df:
+            # Convert to numeric
+            self.df['performance_value'] = pd.to_numeric(self.df['performance_value'], errors='coerce')
     
+    @profiled
     def analyze_data(self):
         """
         Analyzes the data by computing the mean ESG and non-ESG performance values over time, and performing a t-test
@@ -51,11 +148,85 @@ class DataAnalyzer:
         """
         esg_data = self.df[self.df['performance_type'] == 'ESG']
         non_esg_data = self.df[self.df['performance_type'] == 'Non-ESG']
-        esg_data_by_time = esg_data.groupby('time').mean()
-        non_esg_data_by_time = non_esg_data.groupby('time').mean()
+        esg_data_by_time = esg_data.drop(columns='performance_type').groupby('time').mean()
+        non_esg_data_by_time = non_esg_data.drop(columns='performance_type').groupby('time').mean()
         ttest_result = stats.ttest_ind(esg_data['performance_value'], non_esg_data['performance_value'])
         return esg_data_by_time, non_esg_data_by_time, ttest_result
     
+    def _clean_source(self, drop_duplicates):
+        """
+        Returns the SQL subquery equivalent to clean_data on the ESG and non-ESG rows: rows without missing values,
+        optionally de-duplicated, with the performance value converted to a number (NULL when it is not numeric).
+        It takes the two performance types as parameters.
+
+        The type filter is applied to the table itself and the columns are listed in the order of the index of
+        create_indexes, so SQLite can search that index for each type and de-duplicate in index order. The
+        conversion, with the to_number function for text values, only runs on the de-duplicated rows.
+        """
+        others = [column for column in self.columns if column not in ('performance_type', 'time')]
+        columns = ', '.join(map(self._quote, ['performance_type', 'time'] + others))
+        not_null = ' AND '.join(f'{self._quote(column)} IS NOT NULL' for column in self.columns)
+        distinct = 'DISTINCT ' if drop_duplicates else ''
+        rows = (f'SELECT {distinct}{columns} FROM {self._quote(self.table_name)} '
+                f'WHERE performance_type IN (?, ?) AND {not_null}')
+        return (f"SELECT performance_type, time, CASE typeof(performance_value) "
+                f"WHEN 'integer' THEN performance_value WHEN 'real' THEN performance_value "
+                f"WHEN 'text' THEN to_number(performance_value) END AS performance_value FROM ({rows})")
+
+    @profiled
+    def stream_analyze(self, chunksize=100000, drop_duplicates=True, nan_policy='propagate'):
+        """
+        Performs the same analysis as clean_data followed by analyze_data without loading the table into memory.
+        
+        The cleaning, the filter on performance type and the mean by time are pushed down into SQLite as a
+        GROUP BY query, and the t-test is computed from the count, mean and M2 of each group accumulated over
+        chunks of chunksize rows. Call create_indexes first to let SQLite filter and de-duplicate the rows with an
+        index.
+        
+        Args:
+        - chunksize (int): the number of rows read from the database at a time
+        - drop_duplicates (bool): whether to drop duplicate rows like clean_data does
+        - nan_policy (str): 'propagate' to return a NaN t-test when a performance value is not numeric, as
+          analyze_data does after clean_data, or 'omit' to ignore such values
+        
+        Returns:
+        - esg_data_by_time (pandas DataFrame): the mean ESG performance values by time
+        - non_esg_data_by_time (pandas DataFrame): the mean non-ESG performance values by time
+        - ttest_result (StreamingTtestResult): the t-statistic, p-value and degrees of freedom of the t-test
+        """
+        source = self._clean_source(drop_duplicates)
+        types = ('ESG', 'Non-ESG')
+
+        # Mean performance value by type and time, computed by SQLite
+        query = (f'SELECT performance_type, time, AVG(performance_value) AS performance_value FROM ({source}) '
+                 'GROUP BY performance_type, time ORDER BY performance_type, time')
+        means = pd.read_sql_query(query, self.conn, params=types)
+        by_time = [means[means['performance_type'] == t].drop(columns='performance_type').set_index('time')
+                   for t in types]
+
+        # Running sufficient statistics of each group for the t-test
+        running = {t: RunningStats() for t in types}
+        query = f'SELECT performance_type, performance_value FROM ({source})'
+        for chunk in pd.read_sql_query(query, self.conn, params=types, chunksize=chunksize):
+            values = pd.to_numeric(chunk['performance_value'])
+            for t, group in values.groupby(chunk['performance_type']):
+                running[t].update(group)
+        ttest_result = self._ttest(running['ESG'], running['Non-ESG'], nan_policy)
+        return by_time[0], by_time[1], ttest_result
+
+    @staticmethod
+    def _ttest(a, b, nan_policy):
+        """
+        Computes the two-sided t-test with equal variances from the running statistics of both samples.
+        """
+        df = a.count + b.count - 2
+        if (nan_policy == 'propagate' and (a.has_nan or b.has_nan)) or df <= 0:
+            return StreamingTtestResult(math.nan, math.nan, df)
+        pooled = (a.m2 + b.m2) / df
+        statistic = (a.mean - b.mean) / math.sqrt(pooled * (1 / a.count + 1 / b.count))
+        pvalue = 2 * stats.t.sf(abs(statistic), df)
+        return StreamingTtestResult(statistic, pvalue, df)
+    
     def visualize_data(self):
         """
         Visualizes the ESG and non-ESG performance values over time using a line plot.
@@ -68,11 +239,20 @@ class DataAnalyzer:
         plt.legend()
         plt.show()
 
-if __name__ == '__main__':
-    analyzer = DataAnalyzer('mydatabase.db', 'mytable')
-    analyzer.clean_data()
-    analyzer.visualize_data()
-    esg_data_by_time, non_esg_data_by_time, ttest_result = analyzer.analyze_data()
+
+def main(database_name='mydatabase.db', table_name='mytable', plot=True):
+    with stage('data_load'):
+        analyzer = DataAnalyzer(database_name, table_name)
+        analyzer.clean_data()
+    if plot:
+        analyzer.visualize_data()
+    with stage('analyze'):
+        esg_data_by_time, non_esg_data_by_time, ttest_result = analyzer.analyze_data()
     print('ESG Performance Mean:', esg_data_by_time['performance_value'].mean())
     print('Non-ESG Performance Mean:', non_esg_data_by_time['performance_value'].mean())
     print('T-Test Result:', ttest_result)
+    return esg_data_by_time, non_esg_data_by_time, ttest_result
+
+
+if __name__ == '__main__':
+    main()
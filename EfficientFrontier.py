@@ -0,0 +1,498 @@
+"""
+Mean-variance efficient frontier solvers.
+
+Each frontier point is the minimum-variance portfolio for a target expected return. Long-only frontiers are traced
+with the critical line algorithm: the weights are piecewise linear in the target, so one walk over the corner
+portfolios, with rank-one updates of the inverse covariance of the free assets, gives every target by
+interpolation. A primal active-set quadratic programming method, warm-started from the neighbouring target, is
+kept as a fallback for degenerate inputs. Without bounds (budget and target-return constraints only) the frontier
+has the closed-form two-fund solution.
+
+The covariance may be a dense matrix or a Covariance.FactorCovariance, whose portfolio variances, products and
+solves are O(N k); the long-only solvers work on its dense form.
+"""
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.linalg as sla
+import scipy.optimize as sco
+
+from Covariance import FactorCovariance
+from Instrumentation import profiled
+
+
+def _kkt_solve(sigma_free, constraints_free, bounds):
+    """
+    Solves min 0.5 x' sigma x subject to constraints x = bounds, returning x and the multipliers.
+
+    bounds may have several columns, in which case each column is solved for.
+    """
+    n, m = len(sigma_free), len(bounds)
+    kkt = np.zeros((n + m, n + m))
+    kkt[:n, :n] = sigma_free
+    kkt[:n, n:] = constraints_free.T
+    kkt[n:, :n] = constraints_free
+    rhs = np.concatenate([np.zeros((n,) + bounds.shape[1:]), bounds])
+    try:
+        solution = np.linalg.solve(kkt, rhs)
+    except np.linalg.LinAlgError:
+        # Degenerate free set (e.g. fewer free assets than constraints): the system is consistent, so the
+        # least-squares solution is exact
+        solution = np.linalg.lstsq(kkt, rhs, rcond=None)[0]
+    return solution[:n], solution[n:]
+
+
+def active_set_qp(sigma, constraints, bounds, w0, max_iter=None, tol=1e-10):
+    """
+    Solves min 0.5 w' sigma w subject to constraints w = bounds and w >= 0 with a primal active-set method.
+
+    Parameters:
+        sigma (numpy.ndarray): The covariance matrix.
+        constraints (numpy.ndarray): The equality constraint matrix, one row per constraint.
+        bounds (numpy.ndarray): The right-hand side of the equality constraints.
+        w0 (numpy.ndarray): A feasible starting point; its zero weights form the initial working set.
+        max_iter (int): The maximum number of iterations, defaults to 10 times the number of assets.
+        tol (float): The tolerance on steps and multipliers.
+
+    Returns:
+        numpy.ndarray: The optimal weights.
+    """
+    w = np.array(w0, dtype=float)
+    n = len(w)
+    at_zero = w <= tol
+    w[at_zero] = 0.0
+    for _ in range(max_iter or 10 * n):
+        free = np.flatnonzero(~at_zero)
+        x, multipliers = _kkt_solve(sigma[np.ix_(free, free)], constraints[:, free], bounds)
+        step = x - w[free]
+        if np.abs(step).max(initial=0.0) <= tol * (1 + np.abs(w).max()):
+            # Stationary on the working set: release the bound with the most negative multiplier, if any
+            fixed = np.flatnonzero(at_zero)
+            if len(fixed) == 0:
+                return w
+            bound_multipliers = sigma[np.ix_(fixed, free)] @ x + constraints[:, fixed].T @ multipliers
+            worst = np.argmin(bound_multipliers)
+            if bound_multipliers[worst] >= -tol * (1 + np.abs(bound_multipliers).max()):
+                return w
+            at_zero[fixed[worst]] = False
+            continue
+
+        # Move towards the working-set optimum until a weight hits zero
+        decreasing = step < 0
+        ratios = np.full(len(free), np.inf)
+        ratios[decreasing] = -w[free][decreasing] / step[decreasing]
+        blocking = np.argmin(ratios)
+        alpha = min(1.0, ratios[blocking])
+        w[free] += alpha * step
+        if alpha < 1.0:
+            w[free[blocking]] = 0.0
+            at_zero[free[blocking]] = True
+        w[w < 0] = 0.0
+    return w
+
+
+def _dense(sigma):
+    return sigma.to_dense() if isinstance(sigma, FactorCovariance) else np.asarray(sigma, dtype=float)
+
+
+def _solver(sigma):
+    """
+    A function solving sigma x = b: Woodbury for a factor model, one Cholesky factorization otherwise.
+    """
+    if isinstance(sigma, FactorCovariance):
+        return sigma.solve
+    factor = sla.cho_factor(np.asarray(sigma, dtype=float))
+    return lambda vector: sla.cho_solve(factor, vector)
+
+
+def _matvec(sigma, weights):
+    return sigma.matvec(weights) if isinstance(sigma, FactorCovariance) else sigma @ weights
+
+
+def portfolio_variance(weights, sigma):
+    """
+    The variance w' sigma w of one portfolio, or of each row of a weights matrix.
+    """
+    weights = np.asarray(weights, dtype=float)
+    if isinstance(sigma, FactorCovariance):
+        return sigma.variance(weights)
+    return (weights @ np.asarray(sigma, dtype=float) * weights).sum(axis=-1)
+
+
+def min_variance_weights(sigma, long_only=True):
+    """
+    The global minimum-variance portfolio.
+    """
+    if not isinstance(sigma, FactorCovariance):
+        sigma = np.asarray(sigma, dtype=float)
+    n = sigma.shape[0]
+    if not long_only:
+        inverse_ones = _solver(sigma)(np.ones(n))
+        return inverse_ones / inverse_ones.sum()
+    return active_set_qp(_dense(sigma), np.ones((1, n)), np.ones(1), np.full(n, 1.0 / n))
+
+
+def two_fund_frontier(mu, sigma, targets):
+    """
+    Closed-form minimum-variance weights for each target return when the only other constraint is the budget.
+
+    Every frontier portfolio is a combination of the two funds sigma^-1 1 and sigma^-1 mu, so all targets are
+    solved with one Cholesky factorization (or Woodbury solves for a factor model).
+
+    Returns:
+        numpy.ndarray: The weights, one row per target.
+    """
+    mu = np.asarray(mu, dtype=float)
+    solve = _solver(sigma)
+    inverse_ones = solve(np.ones(len(mu)))
+    inverse_mu = solve(mu)
+    a, b, c = inverse_ones.sum(), inverse_mu.sum(), mu @ inverse_mu
+    d = a * c - b * b
+    targets = np.asarray(targets, dtype=float)
+    return np.outer((c - b * targets) / d, inverse_ones) + np.outer((a * targets - b) / d, inverse_mu)
+
+
+def _feasible_start(mu, previous, previous_return, target):
+    """
+    A long-only budget-feasible point with the target return, mixing the previous solution with the single asset
+    of highest (or lowest) expected return.
+    """
+    j = np.argmax(mu) if target >= previous_return else np.argmin(mu)
+    if np.isclose(mu[j], previous_return):
+        return previous.copy()
+    alpha = (target - previous_return) / (mu[j] - previous_return)
+    start = (1 - alpha) * previous
+    start[j] += alpha
+    return start
+
+
+class _WorkingSetLine:
+    """
+    The solution of the equality-constrained problem on a fixed working set, as an affine function of the target.
+
+    Between two corner portfolios the optimal working set does not change and the weights and bound multipliers
+    are linear in the target return, so one factorization serves every target until a weight or multiplier
+    changes sign.
+    """
+
+    def __init__(self, sigma, constraints, weights, tol=1e-10):
+        self.at_zero = weights <= tol
+        self.free = np.flatnonzero(~self.at_zero)
+        self.fixed = np.flatnonzero(self.at_zero)
+        basis = np.array([[1.0, 0.0], [0.0, 1.0]])
+        x, multipliers = _kkt_solve(sigma[np.ix_(self.free, self.free)], constraints[:, self.free], basis)
+        self.x = x
+        self.bound_multipliers = sigma[np.ix_(self.fixed, self.free)] @ x + constraints[:, self.fixed].T @ multipliers
+        self.tol = tol
+
+    def weights(self, target):
+        """
+        The optimal weights for target, or None if the working set is not optimal for it.
+        """
+        point = np.array([1.0, target])
+        x = self.x @ point
+        multipliers = self.bound_multipliers @ point
+        scale = 1 + np.abs(x).max(initial=0.0)
+        if x.min(initial=0.0) < -self.tol * scale or multipliers.min(initial=0.0) < -self.tol * scale:
+            return None
+        w = np.zeros(len(self.at_zero))
+        w[self.free] = np.maximum(x, 0.0)
+        return w
+
+
+def _corner_portfolios(mu, sigma, lowest=None, tol=1e-12, refresh_every=100):
+    """
+    The corner portfolios of the long-only frontier, by the critical line algorithm.
+
+    The walk starts from the single asset with the highest expected return and lowers the target. Between two
+    corners the free set is fixed and the weights, budget and return multipliers and bound multipliers are all
+    linear in the target, so the next corner is where a free weight or a bound multiplier reaches zero. The inverse
+    of the free block of sigma is updated in place in O(free^2) when an asset enters or leaves, instead of solving
+    each corner from scratch.
+
+    Parameters:
+        mu (numpy.ndarray): The expected returns.
+        sigma (numpy.ndarray): The covariance matrix.
+        lowest (float): The walk stops at the first corner at or below this return, defaults to stopping past the
+            minimum-variance portfolio.
+        tol (float): The tolerance on slopes and degenerate corners.
+        refresh_every (int): The number of corners between exact refactorizations of the inverse.
+
+    Returns:
+        tuple: The corner returns in decreasing order, the corner weights (one row per corner) and the derivative of
+        half the variance with respect to the target at each corner, or None if the walk hits a degenerate corner
+        (e.g. tied expected returns), in which case the caller should fall back to active_set_qp.
+    """
+    n = len(mu)
+    order = np.argsort(mu)
+    if n < 2 or mu[order[-1]] - mu[order[-2]] <= tol * (1 + np.abs(mu).max()):
+        return None
+    top = order[-1]
+    constraints = np.vstack([np.ones(n), mu])
+
+    # The second asset is the one that lowers the variance fastest per unit of expected return given up
+    others = np.delete(np.arange(n), top)
+    ratios = (sigma[top, top] - sigma[others, top]) / (mu[top] - mu[others])
+    free = [top, others[np.argmax(ratios)]]
+    # The inverse of sigma on the free set lives in the top-left corner of a preallocated buffer
+    buffer = np.empty((n, n))
+    buffer[:2, :2] = np.linalg.inv(sigma[np.ix_(free, free)])
+    changed = free[-1]
+    current = mu[top]
+    is_free = np.zeros(n, dtype=bool)
+    returns, weights, slopes = [], [], []
+    for iteration in range(4 * n):
+        m = len(free)
+        columns = np.asarray(free)
+        if iteration % refresh_every == refresh_every - 1:
+            # Refactorize now and then so rounding errors of the updates do not accumulate
+            buffer[:m, :m] = np.linalg.inv(sigma[np.ix_(columns, columns)])
+        inverse = buffer[:m, :m]
+        inverse_a = inverse @ constraints[:, columns].T
+        gram = constraints[:, columns] @ inverse_a
+        if np.linalg.det(gram) <= tol * np.trace(gram) ** 2:
+            return None
+        gram_inverse = np.linalg.inv(gram)
+        x = inverse_a @ gram_inverse
+        point = np.array([1.0, current])
+        corner = np.zeros(n)
+        corner[columns] = np.maximum(x @ point, 0.0)
+        returns.append(current)
+        weights.append(corner)
+        slopes.append(gram_inverse[1] @ point)
+        if (current <= lowest) if lowest is not None else (slopes[-1] <= 0):
+            break
+
+        # The next corner below the current one: a free weight or a bound multiplier reaching zero
+        is_free[:] = False
+        is_free[columns] = True
+        fixed = np.flatnonzero(~is_free)
+        full_x = np.zeros((n, 2))
+        full_x[columns] = x
+        bound_multipliers = (sigma @ full_x)[fixed] - constraints[:, fixed].T @ gram_inverse
+        with np.errstate(divide='ignore', invalid='ignore'):
+            leaving = np.where(x[:, 1] > tol, -x[:, 0] / x[:, 1], -np.inf)
+            entering = np.where(bound_multipliers[:, 1] > tol,
+                                -bound_multipliers[:, 0] / bound_multipliers[:, 1], -np.inf)
+        leaving[columns == changed] = -np.inf
+        entering[fixed == changed] = -np.inf
+        leaving, entering = np.minimum(leaving, current), np.minimum(entering, current)
+        k, j = np.argmax(leaving), np.argmax(entering) if len(fixed) else -1
+        if j >= 0 and entering[j] > leaving[k]:
+            current, changed = entering[j], fixed[j]
+            # Bordered update of the inverse for the entering asset
+            b = sigma[columns, changed]
+            u = inverse @ b
+            s = sigma[changed, changed] - b @ u
+            if s <= tol * sigma[changed, changed]:
+                return None
+            inverse += np.multiply.outer(u, u / s)
+            buffer[:m, m] = buffer[m, :m] = -u / s
+            buffer[m, m] = 1.0 / s
+            free.append(changed)
+        elif np.isfinite(leaving[k]):
+            current, changed = leaving[k], columns[k]
+            if m == 2:
+                # Only the asset with the lowest expected return is left
+                corner = np.zeros(n)
+                corner[columns[1 - k]] = 1.0
+                returns.append(mu[columns[1 - k]])
+                weights.append(corner)
+                slopes.append(gram_inverse[1] @ np.array([1.0, mu[columns[1 - k]]]))
+                break
+            # Move the leaving asset to the last position, then downdate the inverse
+            last = m - 1
+            buffer[[k, last], :m] = buffer[[last, k], :m]
+            buffer[:m, [k, last]] = buffer[:m, [last, k]]
+            free[k], free[last] = free[last], free[k]
+            pivot = buffer[last, :last].copy()
+            buffer[:last, :last] -= np.multiply.outer(buffer[:last, last], pivot / buffer[last, last])
+            free.pop()
+        else:
+            return None
+    else:
+        return None
+    return np.array(returns), np.array(weights), np.array(slopes)
+
+
+def _interpolate_corners(corners, targets):
+    """
+    Frontier weights for each target, linear between the two neighbouring corner portfolios.
+    """
+    returns, weights = corners[0][::-1], corners[1][::-1]
+    targets = np.asarray(targets, dtype=float)
+    span = 1e-12 * (1 + np.abs(returns).max())
+    reachable = (targets >= returns[0] - span) & (targets <= returns[-1] + span)
+    upper = np.clip(np.searchsorted(returns, targets), 1, len(returns) - 1)
+    lower = upper - 1
+    width = returns[upper] - returns[lower]
+    fraction = np.clip(np.where(width > 0, (targets - returns[lower]) / np.where(width > 0, width, 1.0), 1.0), 0, 1)
+    result = weights[lower] + fraction[:, None] * (weights[upper] - weights[lower])
+    result[~reachable] = np.nan
+    return result
+
+
+def _corner_min_variance_return(corners):
+    """
+    The expected return of the long-only minimum-variance portfolio, where the variance stops falling.
+    """
+    returns, slopes = corners[0][::-1], corners[2][::-1]
+    k = np.searchsorted(slopes, 0.0)
+    if k == 0:
+        return returns[0]
+    if k == len(returns):
+        return returns[-1]
+    return returns[k - 1] - slopes[k - 1] * (returns[k] - returns[k - 1]) / (slopes[k] - slopes[k - 1])
+
+
+def _slsqp_weights(mu, sigma, target, x0):
+    """
+    Minimum-variance long-only weights for a target return with SLSQP and analytic gradients.
+    """
+    n = len(mu)
+    constraints = (
+        {'type': 'eq', 'fun': lambda w: w.sum() - 1, 'jac': lambda w: np.ones(n)},
+        {'type': 'eq', 'fun': lambda w: w @ mu - target, 'jac': lambda w: mu}
+    )
+    result = sco.minimize(lambda w: 0.5 * w @ sigma @ w, x0, jac=lambda w: sigma @ w, method='SLSQP',
+                          bounds=[(0, 1)] * n, constraints=constraints)
+    return result.x
+
+
+@profiled
+def efficient_frontier(mu, sigma, targets=None, n_points=100, long_only=True, method='critical_line'):
+    """
+    Solves the minimum-variance portfolio for each target return.
+
+    Parameters:
+        mu (array-like): The expected returns.
+        sigma (array-like or FactorCovariance): The covariance matrix.
+        targets (array-like): The target returns, defaults to n_points returns between the minimum-variance
+            portfolio and the highest expected return.
+        n_points (int): The number of default targets.
+        long_only (bool): Whether weights must be non-negative. Without it the closed-form two-fund solution is
+            used.
+        method (str): 'critical_line' to walk the corner portfolios once and interpolate every target between
+            them, 'active_set' for the active-set solver warm-started from the neighbouring target, or 'slsqp' for
+            SciPy's SLSQP with analytic gradients, warm-started from the previous target. 'critical_line' falls back
+            to 'active_set' on degenerate inputs such as tied expected returns.
+
+    Returns:
+        pandas DataFrame: The target return 'mu', the volatility 'vol' and the 'weights' of each frontier
+        portfolio. Targets out of reach of a long-only portfolio have NaN volatility and weights.
+    """
+    mu = np.asarray(mu, dtype=float)
+    covariance = sigma
+    if not isinstance(sigma, FactorCovariance):
+        covariance = sigma = np.asarray(sigma, dtype=float)
+    elif long_only:
+        sigma = sigma.to_dense()
+    n = len(mu)
+    if method not in ('critical_line', 'active_set', 'slsqp'):
+        raise ValueError(f"method must be 'critical_line', 'active_set' or 'slsqp', got {method!r}")
+    corners = None
+    if long_only and method == 'critical_line':
+        corners = _corner_portfolios(mu, sigma, lowest=None if targets is None else np.min(targets, initial=np.inf))
+    if corners is None and method == 'critical_line':
+        method = 'active_set'
+    if targets is None:
+        if corners is not None:
+            start_return = _corner_min_variance_return(corners)
+        else:
+            start_return = min_variance_weights(covariance, long_only) @ mu
+        targets = np.linspace(start_return, mu.max(), n_points)
+    targets = np.asarray(targets, dtype=float)
+
+    if not long_only:
+        weights = two_fund_frontier(mu, covariance, targets)
+    elif corners is not None:
+        weights = _interpolate_corners(corners, targets)
+    else:
+        weights = np.full((len(targets), n), np.nan)
+        constraints = np.vstack([np.ones(n), mu])
+        previous = min_variance_weights(sigma)
+        previous_return = previous @ mu
+        line = None
+        # Solve the targets in increasing order so that each one warm-starts from its neighbour
+        for i in np.argsort(targets):
+            target = targets[i]
+            if not mu.min() - 1e-12 <= target <= mu.max() + 1e-12:
+                continue
+            if method == 'active_set':
+                # Reuse the previous working set while it stays optimal, otherwise re-solve from a feasible start
+                solution = line.weights(target) if line is not None else None
+                if solution is None:
+                    start = _feasible_start(mu, previous, previous_return, target)
+                    solution = active_set_qp(sigma, constraints, np.array([1.0, target]), start)
+                    line = _WorkingSetLine(sigma, constraints, solution)
+                weights[i] = solution
+            else:
+                weights[i] = _slsqp_weights(mu, sigma, target, previous)
+            previous, previous_return = weights[i], weights[i] @ mu
+
+    vol = np.sqrt(portfolio_variance(weights, covariance))
+    return pd.DataFrame({'mu': targets, 'vol': vol, 'weights': list(weights)})
+
+
+@profiled
+def max_sharpe_weights(mu, sigma, risk_free=0.0, long_only=True):
+    """
+    The portfolio with the highest Sharpe ratio, by SLSQP with an analytic gradient.
+    """
+    mu = np.asarray(mu, dtype=float)
+    if not isinstance(sigma, FactorCovariance):
+        sigma = np.asarray(sigma, dtype=float)
+    n = len(mu)
+    excess = mu - risk_free
+
+    def negative_sharpe(w):
+        sigma_w = _matvec(sigma, w)
+        variance = w @ sigma_w
+        volatility = np.sqrt(variance)
+        value = -(w @ excess) / volatility
+        gradient = -excess / volatility + (w @ excess) * sigma_w / (variance * volatility)
+        return value, gradient
+
+    result = sco.minimize(negative_sharpe, np.full(n, 1.0 / n), jac=True, method='SLSQP',
+                          bounds=[(0, 1)] * n if long_only else None,
+                          constraints=({'type': 'eq', 'fun': lambda w: w.sum() - 1,
+                                        'jac': lambda w: np.ones(n)},))
+    return result.x
+
+
+def benchmark(n_assets=(50, 200, 400), n_points=100, slsqp_limit=50, seed=0):
+    """
+    Times the frontier methods on random factor-model covariance matrices.
+
+    Parameters:
+        n_assets (tuple of int): The universe sizes to time.
+        n_points (int): The number of frontier targets.
+        slsqp_limit (int): The largest universe timed with SLSQP, which is much slower.
+        seed (int): The random seed.
+
+    Returns:
+        pandas DataFrame: The seconds taken by each method and the largest volatility excess over the critical line
+        solution, per universe size.
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for n in n_assets:
+        loadings = rng.normal(size=(n, 5))
+        sigma = (0.02 * loadings @ loadings.T + np.diag(rng.uniform(0.01, 0.1, n))) / 252
+        mu = rng.normal(0.08, 0.04, n) / 252
+        methods = ['critical_line', 'active_set'] + (['slsqp'] if n <= slsqp_limit else [])
+        reference = None
+        for method in methods:
+            start = time.perf_counter()
+            frontier = efficient_frontier(mu, sigma, targets=reference, n_points=n_points, method=method)
+            seconds = time.perf_counter() - start
+            if reference is None:
+                reference, reference_vol = frontier['mu'].to_numpy(), frontier['vol'].to_numpy()
+            rows.append({'n_assets': n, 'method': method, 'seconds': seconds,
+                         'vol_excess': np.nanmax(frontier['vol'].to_numpy() - reference_vol)})
+    return pd.DataFrame(rows).set_index(['n_assets', 'method'])
+
+
+if __name__ == '__main__':
+    print(benchmark())
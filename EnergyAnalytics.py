@@ -1,58 +1,73 @@
 """
-Supply and demand modeling:
+Supply and demand modeling, price forecasting and storage optimization.
 """
-import pandas as pd
-import statsmodels.api as sm
+import numpy as np
+from sklearn.linear_model import LinearRegression
 
-# Load historical supply and demand data
-data = pd.read_csv('supply_demand_data.csv')
+from DemandForecast import DemandForecaster
+from Instrumentation import stage
+from PriceStore import read_table
+from StorageDispatch import StorageFacility, dispatch
 
-# Fit a time series model to the data
-model = sm.tsa.ARIMA(data['demand'], order=(1, 1, 1)).fit()
 
-# Forecast future demand
-forecast = model.forecast(steps=12)
+def forecast_demand(path='supply_demand_data.csv', steps=12):
+    """
+    Supply and demand modeling: forecasts demand with an ARIMA(1,1,1) model.
+    """
+    # Load historical supply and demand data
+    with stage('data_load'):
+        data = read_table(path, date_column=None)
 
-"""
-Price forecasting:
-"""
-import pandas as pd
-import numpy as np
-from sklearn.linear_model import LinearRegression
+    # Fit an ARIMA(1,1,1) model to the data; more delivery points are just more columns
+    with stage('model_fit'):
+        forecaster = DemandForecaster().fit(data[['demand']])
 
-# Load historical price data
-data = pd.read_csv('price_data.csv')
+    # Forecast future demand
+    return forecaster.forecast(steps=steps)['demand']
 
-# Split the data into training and testing sets
-train_data = data[:-12]
-test_data = data[-12:]
 
-# Fit a linear regression model to the training data
-model = LinearRegression()
-model.fit(train_data[['supply', 'demand', 'storage']], train_data['price'])
+def forecast_prices(path='price_data.csv'):
+    """
+    Price forecasting: predicts the last 12 prices from supply, demand and storage with a linear regression.
+    """
+    # Load historical price data
+    with stage('data_load'):
+        data = read_table(path, date_column=None)
 
-# Make predictions on the testing data
-predictions = model.predict(test_data[['supply', 'demand', 'storage']])
+    # Split the data into training and testing sets
+    train_data = data[:-12]
+    test_data = data[-12:]
 
-"""
-Storage optimization:
-"""
-import pandas as pd
-import scipy.optimize as optimize
-
-# Load historical storage data
-data = pd.read_csv('storage_data.csv')
-
-# Define an objective function to minimize injections and withdrawals
-def storage_objective(x, data):
-    injections = x[:12]
-    withdrawals = x[12:]
-    storage = data['start_storage']
-    for i in range(12):
-        storage += injections[i] - withdrawals[i]
-    return abs(storage - data['end_storage'])
-
-# Find the optimal injection and withdrawal strategy
-x0 = [0]*24
-bounds = [(0, None)]*24
-res = optimize.minimize(storage_objective, x0, args=(data,), bounds=bounds)
+    # Fit a linear regression model to the training data
+    with stage('model_fit'):
+        model = LinearRegression()
+        model.fit(train_data[['supply', 'demand', 'storage']], train_data['price'])
+
+    # Make predictions on the testing data
+    return model.predict(test_data[['supply', 'demand', 'storage']])
+
+
+def optimize_storage(path='storage_data.csv'):
+    """
+    Storage optimization: the least-cost injections and withdrawals that reach the end inventory.
+    """
+    # Load historical storage data
+    with stage('data_load'):
+        data = read_table(path, date_column=None)
+
+    # Reach the end inventory over 12 periods at the least injection and withdrawal, as a linear program
+    facility = StorageFacility(start_inventory=data['start_storage'].iloc[0], end_inventory=data['end_storage'].iloc[0],
+                               injection_cost=1.0, withdrawal_cost=1.0)
+    with stage('optimize'):
+        return dispatch([facility], np.zeros(12))
+
+
+def main():
+    forecast = forecast_demand()
+    predictions = forecast_prices()
+    res = optimize_storage()
+    return forecast, predictions, res
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+"""
+External market feeds (weather and pipeline flows) for the gas trading strategies.
+
+Providers share a pooled HTTP session, are fetched concurrently with asyncio and sit behind a TTL cache. Replay
+providers read point-in-time values from local files so backtests can run offline, and StubFeedServer serves the
+same JSON shapes as the live endpoints for tests.
+"""
+import asyncio
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class TTLCache:
+    """
+    A thread-safe least-recently-used cache whose entries expire after a fixed time to live.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, clock=time.monotonic):
+        """
+        Parameters:
+            maxsize (int): The maximum number of entries; the least recently used entry is evicted beyond it.
+            ttl (float): The number of seconds an entry stays valid.
+            clock (callable): The time source, in seconds.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires <= self.clock():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FeedProvider(ABC):
+    """
+    The interface of a feed: returns a single value for a point in time.
+    """
+
+    name = None
+
+    @abstractmethod
+    def fetch(self, ts=None, session=None):
+        """
+        Returns the value of the feed at ts, or the latest value when ts is None.
+
+        Parameters:
+            ts (pandas Timestamp): The point in time of the request.
+            session (requests Session): The pooled HTTP session to use for remote requests.
+        """
+
+    def cache_key(self, ts=None):
+        """
+        Returns the key under which a fetched value is cached.
+        """
+        return self.name, ts
+
+
+class HttpFeedProvider(FeedProvider):
+    """
+    A live feed read from a JSON HTTP endpoint. Live endpoints only know the current value, so ts is ignored.
+    """
+
+    def __init__(self, name, url, params=None, timeout=5.0):
+        """
+        Parameters:
+            name (str): The name of the value in a feed snapshot.
+            url (str): The endpoint URL.
+            params (dict): The query parameters of the request.
+            timeout (float): The connect and read timeout in seconds.
+        """
+        self.name = name
+        self.url = url
+        self.params = params
+        self.timeout = timeout
+
+    @abstractmethod
+    def extract(self, payload):
+        """
+        Extracts the feed value from the decoded JSON payload.
+        """
+
+    def fetch(self, ts=None, session=None):
+        response = (session or requests).get(self.url, params=self.params, timeout=self.timeout)
+        response.raise_for_status()
+        return self.extract(response.json())
+
+    def cache_key(self, ts=None):
+        return self.name, None
+
+
+class WeatherFeed(HttpFeedProvider):
+    """
+    The current temperature of a city from OpenWeatherMap.
+    """
+
+    def __init__(self, city, api_key, base_url='http://api.openweathermap.org', name='temp', timeout=5.0):
+        super().__init__(name, base_url.rstrip('/') + '/data/2.5/weather', params={'q': city, 'appid': api_key},
+                         timeout=timeout)
+
+    def extract(self, payload):
+        return payload['main']['temp']
+
+
+class PipelineFlowFeed(HttpFeedProvider):
+    """
+    The current flow of the first pipeline reported by the pipelines API.
+    """
+
+    def __init__(self, base_url='https://api.pipelines.com', name='flow', timeout=5.0):
+        super().__init__(name, base_url.rstrip('/') + '/v1/flows', timeout=timeout)
+
+    def extract(self, payload):
+        return payload['flows'][0]['flow']
+
+
+class ReplayFeedProvider(FeedProvider):
+    """
+    A historical feed read from a local CSV file, returning the last value known at each point in time.
+    """
+
+    def __init__(self, name, path, column=None, time_column='date'):
+        """
+        Parameters:
+            name (str): The name of the value in a feed snapshot.
+            path (str): The CSV file holding the history.
+            column (str): The column holding the values, defaults to name.
+            time_column (str): The column holding the timestamps.
+        """
+        self.name = name
+        history = pd.read_csv(path, usecols=[time_column, column or name])
+        history[time_column] = pd.to_datetime(history[time_column])
+        history = history.sort_values(time_column)
+        self.times = history[time_column].to_numpy(dtype='datetime64[ns]')
+        self.values = history[column or name].to_numpy()
+
+    def fetch(self, ts=None, session=None):
+        if ts is None:
+            return self.values[-1]
+        i = np.searchsorted(self.times, np.datetime64(pd.Timestamp(ts), 'ns'), side='right') - 1
+        if i < 0:
+            raise KeyError(f'no {self.name} value at or before {ts}')
+        return self.values[i]
+
+    def cache_key(self, ts=None):
+        # Local lookups are cheaper than the cache
+        return None
+
+
+class FeedLayer:
+    """
+    Fetches a set of feeds concurrently over a pooled session, caching the results.
+    """
+
+    def __init__(self, providers, cache=None, session=None, pool_size=10):
+        """
+        Parameters:
+            providers (list of FeedProvider): The feeds to fetch; their names are the keys of a snapshot.
+            cache (TTLCache): The cache of fetched values, defaults to a cache with a 5 minute time to live.
+            session (requests Session): The HTTP session, defaults to a new session with a connection pool.
+            pool_size (int): The size of the connection pool of the default session.
+        """
+        self.providers = list(providers)
+        self.cache = cache if cache is not None else TTLCache()
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+
+    def _fetch_one(self, provider, ts):
+        key = provider.cache_key(ts)
+        if key is not None:
+            value = self.cache.get(key)
+            if value is not None:
+                return value
+        value = provider.fetch(ts, session=self.session)
+        if key is not None:
+            self.cache.set(key, value)
+        return value
+
+    async def fetch_all(self, ts=None):
+        """
+        Fetches every feed concurrently.
+
+        Returns:
+            dict: The value of each feed, keyed by provider name.
+        """
+        values = await asyncio.gather(*(asyncio.to_thread(self._fetch_one, provider, ts)
+                                        for provider in self.providers))
+        return {provider.name: value for provider, value in zip(self.providers, values)}
+
+    def snapshot(self, ts=None):
+        """
+        Synchronous form of fetch_all for callers outside an event loop.
+        """
+        return asyncio.run(self.fetch_all(ts))
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def live_feeds(city='Houston', api_key='1234567890', weather_url='http://api.openweathermap.org',
+               pipeline_url='https://api.pipelines.com', ttl=300):
+    """
+    Returns the feed layer for the live weather and pipeline flow endpoints.
+    """
+    return FeedLayer([WeatherFeed(city, api_key, base_url=weather_url),
+                      PipelineFlowFeed(base_url=pipeline_url)], cache=TTLCache(ttl=ttl))
+
+
+def replay_feeds(weather_path, flow_path, time_column='date'):
+    """
+    Returns a feed layer replaying historical temperatures and pipeline flows from local CSV files with 'temp'
+    and 'flow' columns.
+    """
+    return FeedLayer([ReplayFeedProvider('temp', weather_path, time_column=time_column),
+                      ReplayFeedProvider('flow', flow_path, time_column=time_column)])
+
+
+class StubFeedServer:
+    """
+    A local HTTP server standing in for the weather and pipeline endpoints.
+
+    Use as a context manager and point the feeds at its url:
+
+        with StubFeedServer(temp=45, flow=6000) as server:
+            feeds = live_feeds(weather_url=server.url, pipeline_url=server.url)
+    """
+
+    def __init__(self, temp=45.0, flow=6000.0):
+        self.temp = temp
+        self.flow = flow
+        self.requests = []
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                stub.requests.append((parsed.path, parse_qs(parsed.query)))
+                if parsed.path == '/data/2.5/weather':
+                    payload = {'main': {'temp': stub.temp}}
+                elif parsed.path == '/v1/flows':
+                    payload = {'flows': [{'flow': stub.flow}]}
+                else:
+                    self.send_error(404)
+                    return
+                body = json.dumps(payload).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
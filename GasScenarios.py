@@ -0,0 +1,321 @@
+"""
+What-if scenarios over the GasNetwork dispatch model: pipeline outages, supply cuts and demand shocks.
+
+The base network is compiled into linprog arrays once. A scenario only changes right-hand sides and variable
+bounds, so it is applied as a handful of index/value patches to copies of those arrays and the sparse constraint
+matrix is shared by every scenario and shipped to each worker process once. linprog exposes no basis warm start,
+so each scenario starts from the base-case solution instead: when the base flows stay feasible under the patched
+bounds and no binding constraint was changed, the base solution (and its prices) is still optimal and the solve is
+skipped altogether. Remaining scenarios are solved in parallel across a process pool.
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import linprog
+
+from GasNetwork import GasNetworkModel, synthetic_grid
+from Instrumentation import profiled
+
+# Worker-side state, set up once per process by _init_worker
+_lp = None
+_base = None
+
+
+class Scenario:
+    """
+    A set of changes to the base network, given as new values.
+
+    Nodes are keyed by name. Edges are keyed by their index in the model, or by (tail, head) node names, which
+    stand for every pipeline from tail to head when there are parallel pipelines.
+    """
+
+    def __init__(self, name, edge_capacity=None, supply_capacity=None, demand=None, node_capacity=None):
+        """
+        Parameters:
+            name (str): The name of the scenario.
+            edge_capacity (dict): New pipeline capacities, e.g. {('A', 'B'): 0} for an outage.
+            supply_capacity (dict): New supply capacities by node.
+            demand (dict): New demands by node.
+            node_capacity (dict): New throughput capacities by node; nodes must already be capacitated in the base.
+        """
+        self.name = name
+        self.edge_capacity = dict(edge_capacity or {})
+        self.supply_capacity = dict(supply_capacity or {})
+        self.demand = dict(demand or {})
+        self.node_capacity = dict(node_capacity or {})
+
+
+class ScenarioResult:
+    """
+    The dispatch of every scenario.
+
+    Attributes:
+        flows (pandas DataFrame): The scenario x pipeline flow matrix, with one (tail, head) column per pipeline in
+            the order of the model's edges, so parallel pipelines share a label.
+        prices (pandas DataFrame): The scenario x node matrix of nodal prices.
+        summary (pandas DataFrame): The status, cost and whether the base solution was reused, per scenario.
+    """
+
+    def __init__(self, flows, prices, summary):
+        self.flows = flows
+        self.prices = prices
+        self.summary = summary
+
+
+def _init_worker(lp, base):
+    global _lp, _base
+    _lp, _base = lp, base
+
+
+def _release_worker():
+    global _lp, _base
+    _lp, _base = None, None
+
+
+def _solve(task):
+    """
+    Solves a batch of compiled scenarios, reusing the base solution where it stays optimal.
+    """
+    rows = []
+    for position, columns, upper, b_rows, b_values in task:
+        bounds = _lp['bounds']
+        x = _base['x']
+        if np.array_equal(_lp['b_eq'][b_rows], b_values) and \
+                np.all(x[columns] <= upper + 1e-9) and np.all(np.abs(_base['upper_marginals'][columns]) <= 1e-9):
+            # Still primal feasible, and every changed bound has a zero reduced cost: the base stays optimal
+            rows.append((position, 0, _base['cost'], x, _base['prices'], True))
+            continue
+        bounds = bounds.copy()
+        bounds[columns, 1] = upper
+        b_eq = _lp['b_eq'].copy()
+        b_eq[b_rows] = b_values
+        result = linprog(_lp['c'], A_eq=_lp['A_eq'], b_eq=b_eq, bounds=bounds, method=_lp['method'])
+        if result.status == 0:
+            rows.append((position, 0, result.fun, result.x, result.eqlin.marginals, False))
+        else:
+            rows.append((position, result.status, np.nan, None, None, False))
+    return rows
+
+
+class ScenarioRunner:
+    """
+    Runs many what-if scenarios against one compiled base network.
+    """
+
+    def __init__(self, model, shortfall_cost=None, method='highs-ipm'):
+        """
+        Parameters:
+            model (GasNetworkModel): The base network.
+            shortfall_cost (float): The cost per unit of unmet demand; with it, scenarios that cannot meet demand
+                still solve and report the shortfall cost instead of failing. Every node gets a shortfall variable,
+                bounded by its demand, so demand shocks can reach nodes without demand in the base network.
+            method (str): The linprog method.
+        """
+        self.model = model
+        self.shortfall_cost = shortfall_cost
+        self.lp = dict(model.to_lp(shortfall_cost, consumers=np.arange(model.n_nodes)), method=method)
+        _, _, _, capacity, _, split = model.split_network()
+        self.n_flows = len(capacity)
+        # The indices of the pipelines between each pair of nodes, several for parallel pipelines
+        self._edges = {}
+        for i, (t, h) in enumerate(zip(model.tails, model.heads)):
+            self._edges.setdefault((model.nodes[t], model.nodes[h]), []).append(i)
+        self._nodes = {node: i for i, node in enumerate(model.nodes)}
+        self._supply_columns = {i: self.n_flows + j for j, i in enumerate(self.lp['suppliers'])}
+        offset = self.n_flows + len(self.lp['suppliers'])
+        self._shortfall_columns = {i: offset + j for j, i in enumerate(self.lp['consumers'])}
+        self._node_columns = {i: model.n_edges + j for j, i in enumerate(split)}
+
+        result = linprog(self.lp['c'], A_eq=self.lp['A_eq'], b_eq=self.lp['b_eq'], bounds=self.lp['bounds'],
+                         method=method)
+        if result.status != 0:
+            raise ValueError(f'the base network has no dispatch: {result.message}')
+        self.base = {'x': result.x, 'cost': result.fun, 'prices': result.eqlin.marginals,
+                     'upper_marginals': result.upper.marginals}
+
+    def outage(self, tail, head, name=None):
+        """
+        A scenario with the pipeline from tail to head out of service, or all of them if there are several.
+        """
+        return Scenario(name or f'outage {tail}->{head}', edge_capacity={(tail, head): 0.0})
+
+    def _edge_indices(self, key):
+        """
+        The pipeline indices of an edge key: an edge index or a (tail, head) pair.
+        """
+        if isinstance(key, (int, np.integer)):
+            if not 0 <= key < self.model.n_edges:
+                raise KeyError(f'no edge with index {key}')
+            return [int(key)]
+        if key not in self._edges:
+            raise KeyError(f'no pipeline from {key[0]!r} to {key[1]!r}')
+        return self._edges[key]
+
+    def scale_supply(self, node, factor, name=None):
+        """
+        A scenario with the supply capacity of a node scaled, e.g. 0.5 for an LNG terminal at half capacity.
+        """
+        capacity = self.model.supply_capacity[self._nodes[node]] * factor
+        return Scenario(name or f'supply {node} x{factor:g}', supply_capacity={node: capacity})
+
+    def scale_demand(self, node, factor, name=None):
+        """
+        A scenario with the demand of a node scaled, e.g. 1.3 for a power-plant demand spike.
+        """
+        demand = self.model.demand[self._nodes[node]] * factor
+        return Scenario(name or f'demand {node} x{factor:g}', demand={node: demand})
+
+    def compile(self, scenario):
+        """
+        Turns a scenario into patches of the base linprog arrays.
+
+        Returns:
+            tuple: The variable columns and their new upper bounds, and the equality rows and their new right-hand
+            sides.
+        """
+        columns, upper, b_rows, b_values = [], [], [], []
+        for key, value in scenario.edge_capacity.items():
+            indices = self._edge_indices(key)
+            columns.extend(indices)
+            upper.extend([value] * len(indices))
+        for node, value in scenario.node_capacity.items():
+            i = self._nodes[node]
+            if i not in self._node_columns:
+                raise KeyError(f'node {node!r} has no capacity in the base network')
+            columns.append(self._node_columns[i])
+            upper.append(value)
+        for node, value in scenario.supply_capacity.items():
+            i = self._nodes[node]
+            if i not in self._supply_columns:
+                raise KeyError(f'node {node!r} has no supply in the base network')
+            columns.append(self._supply_columns[i])
+            upper.append(value)
+        for node, value in scenario.demand.items():
+            i = self._nodes[node]
+            b_rows.append(i)
+            b_values.append(value)
+            if self.shortfall_cost is not None:
+                columns.append(self._shortfall_columns[i])
+                upper.append(value)
+        return (np.array(columns, dtype=np.int64), np.array(upper, dtype=float),
+                np.array(b_rows, dtype=np.int64), np.array(b_values, dtype=float))
+
+    def apply(self, scenario):
+        """
+        Builds the scenario as a new GasNetworkModel, for a from-scratch solve.
+        """
+        model = self.model
+        edge_capacity, node_capacity = model.edge_capacity.copy(), model.node_capacity.copy()
+        supply_capacity, demand = model.supply_capacity.copy(), model.demand.copy()
+        for key, value in scenario.edge_capacity.items():
+            edge_capacity[self._edge_indices(key)] = value
+        for mapping, values in ((scenario.node_capacity, node_capacity), (scenario.supply_capacity, supply_capacity),
+                                (scenario.demand, demand)):
+            for node, value in mapping.items():
+                values[self._nodes[node]] = value
+        return GasNetworkModel(model.nodes, model.tails, model.heads, edge_capacity, model.edge_cost,
+                               supply_capacity, model.supply_cost, demand, node_capacity)
+
+    @profiled
+    def run(self, scenarios, max_workers=None, chunk_size=None):
+        """
+        Solves every scenario.
+
+        Parameters:
+            scenarios (list of Scenario): The scenarios.
+            max_workers (int): The number of worker processes, defaults to the number of CPUs. With 1 the
+                scenarios run in the calling process.
+            chunk_size (int): The number of scenarios sent to a worker at once, defaults to an even split into four
+                batches per worker.
+
+        Returns:
+            ScenarioResult: The flows, nodal prices and summary of every scenario.
+        """
+        scenarios = list(scenarios)
+        compiled = [(i,) + self.compile(scenario) for i, scenario in enumerate(scenarios)]
+        max_workers = max_workers or os.cpu_count() or 1
+        chunk_size = chunk_size or max(1, -(-len(compiled) // (4 * max_workers)))
+        tasks = [compiled[i:i + chunk_size] for i in range(0, len(compiled), chunk_size)]
+        if max_workers == 1:
+            _init_worker(self.lp, self.base)
+            try:
+                results = [_solve(task) for task in tasks]
+            finally:
+                _release_worker()
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                     initargs=(self.lp, self.base)) as executor:
+                results = list(executor.map(_solve, tasks))
+
+        m, n = self.model.n_edges, self.model.n_nodes
+        flows = np.full((len(scenarios), m), np.nan)
+        prices = np.full((len(scenarios), n), np.nan)
+        status, cost, reused = np.zeros(len(scenarios), dtype=int), np.full(len(scenarios), np.nan), \
+            np.zeros(len(scenarios), dtype=bool)
+        for position, scenario_status, scenario_cost, x, marginals, base_reused in (row for batch in results
+                                                                                    for row in batch):
+            status[position], cost[position], reused[position] = scenario_status, scenario_cost, base_reused
+            if x is not None:
+                flows[position] = x[:m]
+                prices[position] = marginals[:n]
+        names = pd.Index([scenario.name for scenario in scenarios], name='scenario')
+        nodes = np.asarray(self.model.nodes, dtype=object)
+        edge_index = pd.MultiIndex.from_arrays([nodes[self.model.tails], nodes[self.model.heads]],
+                                               names=['tail', 'head'])
+        return ScenarioResult(pd.DataFrame(flows, index=names, columns=edge_index),
+                              pd.DataFrame(prices, index=names, columns=pd.Index(self.model.nodes, name='node')),
+                              pd.DataFrame({'status': status, 'cost': cost, 'reused_base': reused}, index=names))
+
+
+def random_scenarios(runner, n_scenarios, seed=0):
+    """
+    A random mix of single-pipeline outages, supply cuts and demand spikes.
+    """
+    rng = np.random.default_rng(seed)
+    model = runner.model
+    suppliers = [model.nodes[i] for i in runner.lp['suppliers']]
+    consumers = [model.nodes[i] for i in np.flatnonzero(model.demand > 0)]
+    edges = list(runner._edges)
+    scenarios = []
+    for i in range(n_scenarios):
+        kind = rng.random()
+        if kind < 0.6:
+            tail, head = edges[rng.integers(len(edges))]
+            scenarios.append(runner.outage(tail, head, name=f's{i} outage {tail}->{head}'))
+        elif kind < 0.8:
+            node = suppliers[rng.integers(len(suppliers))]
+            scenarios.append(runner.scale_supply(node, 0.5, name=f's{i} supply {node}'))
+        else:
+            node = consumers[rng.integers(len(consumers))]
+            scenarios.append(runner.scale_demand(node, 1.5, name=f's{i} demand {node}'))
+    return scenarios
+
+
+def benchmark(grid=(30, 30), n_scenarios=200, worker_counts=(1, 2, 4), shortfall_cost=100.0, seed=0):
+    """
+    Compares rebuilding and re-solving every scenario from scratch with the scenario runner.
+
+    Returns:
+        pandas DataFrame: The wall time of each approach and the share of scenarios that reused the base solution.
+    """
+    model = synthetic_grid(*grid, seed=seed)
+    runner = ScenarioRunner(model, shortfall_cost=shortfall_cost)
+    scenarios = random_scenarios(runner, n_scenarios, seed=seed)
+    rows = []
+    start = time.perf_counter()
+    naive_costs = [runner.apply(scenario).solve(shortfall_cost).cost for scenario in scenarios]
+    rows.append({'approach': 'rebuild', 'seconds': time.perf_counter() - start, 'reused_share': 0.0})
+    for workers in worker_counts:
+        start = time.perf_counter()
+        result = runner.run(scenarios, max_workers=workers)
+        rows.append({'approach': f'runner_{workers}_workers', 'seconds': time.perf_counter() - start,
+                     'reused_share': result.summary['reused_base'].mean(),
+                     'max_cost_error': np.nanmax(np.abs(result.summary['cost'].to_numpy() - naive_costs))})
+    return pd.DataFrame(rows).set_index('approach')
+
+
+if __name__ == '__main__':
+    print(benchmark())
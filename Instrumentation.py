@@ -0,0 +1,270 @@
+"""
+Timing and memory instrumentation for named stages of the TradeDesk scripts.
+
+Code marks its stages with the stage() context manager or the profiled decorator. Both record, per stage name, the
+number of calls, the wall and CPU time and the peak memory allocated while the stage ran (with tracemalloc). The
+profiler is off by default: stage() then hands back one shared no-op context manager and a profiled function makes
+a single attribute check before calling through, so instrumented hot paths cost next to nothing in normal runs.
+
+Every script has an importable main(), so a harness can run any of them under the profiler:
+
+    python Instrumentation.py AlgoGasDesk --json report.json
+"""
+import argparse
+import contextlib
+import functools
+import importlib
+import json
+import threading
+import time
+import tracemalloc
+
+_NULL_STAGE = contextlib.nullcontext()
+
+
+class Profiler:
+    """
+    Collects the statistics of named stages.
+
+    CPU time is the process time, so it includes every thread of the process but not worker processes. Peak memory
+    is traced for the whole process, so stages running at the same time in different threads see each other's
+    allocations.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._started_tracing = False
+
+    def enable(self, memory=True):
+        """
+        Starts recording stages.
+
+        Parameters:
+            memory (bool): Whether to trace peak allocations with tracemalloc, which slows allocation-heavy code.
+        """
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self.memory = memory
+        self.enabled = True
+
+    def disable(self):
+        """
+        Stops recording stages, keeping the statistics recorded so far.
+        """
+        self.enabled = False
+        self.memory = False
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def reset(self):
+        """
+        Discards the recorded statistics.
+        """
+        with self._lock:
+            self._stats = {}
+
+    def stage(self, name):
+        """
+        A context manager recording one run of a named stage; a no-op while the profiler is disabled.
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return self._stage(name)
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        stack = self._local.__dict__.setdefault('stack', [])
+        memory = self.memory and tracemalloc.is_tracing()
+        # Each open stage keeps the traced memory at entry and the highest peak seen so far inside it
+        frame = [0, 0]
+        if memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1][1] = max(stack[-1][1], peak)
+            tracemalloc.reset_peak()
+            frame = [current, current]
+        stack.append(frame)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            stack.pop()
+            peak_bytes = None
+            if memory and tracemalloc.is_tracing():
+                peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+                peak_bytes = peak - frame[0]
+                if stack:
+                    stack[-1][1] = max(stack[-1][1], peak)
+            with self._lock:
+                stats = self._stats.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                                      'peak_bytes': None})
+                stats['calls'] += 1
+                stats['wall_seconds'] += wall
+                stats['cpu_seconds'] += cpu
+                if peak_bytes is not None:
+                    stats['peak_bytes'] = max(stats['peak_bytes'] or 0, peak_bytes)
+
+    def report(self):
+        """
+        The statistics of every stage recorded so far.
+
+        Returns:
+            dict: For each stage name, its calls, total and mean wall seconds, total CPU seconds and peak bytes
+            allocated during any one call (None if memory was not traced).
+        """
+        with self._lock:
+            stats = {name: dict(values) for name, values in self._stats.items()}
+        for values in stats.values():
+            values['mean_wall_seconds'] = values['wall_seconds'] / values['calls']
+        return stats
+
+    def to_json(self, path=None, indent=2):
+        """
+        Exports the report as JSON.
+
+        Parameters:
+            path (str): The file to write, if any.
+            indent (int): The JSON indentation.
+
+        Returns:
+            str: The JSON document.
+        """
+        document = json.dumps({'stages': self.report()}, indent=indent)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(document)
+        return document
+
+
+# The profiler shared by every module
+PROFILER = Profiler()
+
+
+def stage(name):
+    """
+    A context manager recording one run of a named stage with the shared profiler.
+    """
+    if not PROFILER.enabled:
+        return _NULL_STAGE
+    return PROFILER._stage(name)
+
+
+def profiled(name=None):
+    """
+    Decorates a function so each call is recorded as a stage of the shared profiler.
+
+    Use it as @profiled, which names the stage after the function's module and qualified name, or as
+    @profiled('stage name').
+    """
+    def decorate(function):
+        label = name or f'{function.__module__}.{function.__qualname__}'
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return function(*args, **kwargs)
+            with PROFILER._stage(label):
+                return function(*args, **kwargs)
+        return wrapper
+
+    if callable(name):
+        function, name = name, None
+        return decorate(function)
+    return decorate
+
+
+def run(entry_point, *args, memory=True, **kwargs):
+    """
+    Runs a function with the shared profiler enabled, as one stage named after it, from a clean report.
+
+    Parameters:
+        entry_point (callable): The function, typically a script's main.
+        memory (bool): Whether to trace peak allocations.
+
+    Returns:
+        tuple: The function's result and the report.
+    """
+    was_enabled = PROFILER.enabled
+    PROFILER.reset()
+    PROFILER.enable(memory=memory)
+    try:
+        with PROFILER.stage(f'{entry_point.__module__}.{entry_point.__qualname__}'):
+            result = entry_point(*args, **kwargs)
+    finally:
+        if not was_enabled:
+            PROFILER.disable()
+    return result, PROFILER.report()
+
+
+def benchmark(n_calls=200000):
+    """
+    Measures the cost per call of a profiled function and of a stage, with the profiler disabled and enabled.
+
+    Returns:
+        dict: The nanoseconds added per call in each mode.
+    """
+    def plain():
+        return None
+
+    decorated = profiled('benchmark')(plain)
+    was_enabled, was_memory = PROFILER.enabled, PROFILER.memory
+    timings = {}
+
+    start = time.perf_counter()
+    for _ in range(n_calls):
+        plain()
+    baseline = time.perf_counter() - start
+
+    PROFILER.disable()
+    start = time.perf_counter()
+    for _ in range(n_calls):
+        decorated()
+    timings['disabled_decorator_ns'] = (time.perf_counter() - start - baseline) / n_calls * 1e9
+    start = time.perf_counter()
+    for _ in range(n_calls):
+        with stage('benchmark'):
+            pass
+    timings['disabled_stage_ns'] = (time.perf_counter() - start) / n_calls * 1e9
+
+    for memory in (False, True):
+        PROFILER.enable(memory=memory)
+        start = time.perf_counter()
+        for _ in range(n_calls):
+            decorated()
+        timings[f'enabled_decorator{"_memory" if memory else ""}_ns'] = \
+            (time.perf_counter() - start - baseline) / n_calls * 1e9
+        PROFILER.disable()
+    with PROFILER._lock:
+        PROFILER._stats.pop('benchmark', None)
+    if was_enabled:
+        PROFILER.enable(memory=was_memory)
+    return timings
+
+
+def main(argv=None):
+    """
+    Runs a script's entry point under the profiler and prints or writes the JSON report.
+    """
+    parser = argparse.ArgumentParser(description='Profile the entry point of a TradeDesk script.')
+    parser.add_argument('target', help='the module to run, optionally with the function: Module[:function]')
+    parser.add_argument('--json', help='the file to write the report to')
+    parser.add_argument('--no-memory', action='store_true', help='do not trace peak allocations')
+    arguments = parser.parse_args(argv)
+    module_name, _, function_name = arguments.target.partition(':')
+    entry_point = getattr(importlib.import_module(module_name), function_name or 'main')
+    run(entry_point, memory=not arguments.no_memory)
+    document = PROFILER.to_json(arguments.json)
+    if arguments.json is None:
+        print(document)
+    return PROFILER.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""
+Low-latency prediction front-end for the TradingPredictor models.
+
+Single-row requests from many callers are collected into micro-batches over a short time window and scored with
+one model call per batch, which amortizes the per-call overhead of the scikit-learn pipelines.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+class MicroBatcher:
+    """
+    Groups single-row prediction requests into batches.
+
+    A background thread waits for the first pending request, then keeps collecting requests until the batch is
+    full or max_wait seconds have passed, and scores the whole batch with a single call to predict_fn.
+    """
+
+    def __init__(self, predict_fn, features, max_batch_size=64, max_wait=0.002):
+        """
+        Parameters:
+            predict_fn (callable): Scores a DataFrame of rows and returns one prediction per row, e.g. the predict
+                method of a fitted pipeline.
+            features (list of str): The columns of the DataFrame passed to predict_fn.
+            max_batch_size (int): The largest number of rows scored in one call.
+            max_wait (float): The longest time in seconds a request waits for others to join its batch.
+        """
+        self.predict_fn = predict_fn
+        self.features = list(features)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batch_sizes = []
+        self._requests = queue.Queue()
+        self._closed = False
+        # Makes the closed check and the queueing of a request atomic, so no request lands behind the sentinel
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, row):
+        """
+        Queues a row for prediction.
+
+        Parameters:
+            row (dict or sequence): The feature values, keyed by feature name or in the order of features.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the prediction of the row.
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('the batcher is closed')
+            self._requests.put((row, future))
+        return future
+
+    def predict(self, row, timeout=None):
+        """
+        Predicts a single row, blocking until its batch has been scored.
+        """
+        return self.submit(row).result(timeout)
+
+    def _collect(self):
+        """
+        Waits for a batch of requests, leaving out those cancelled while queued; None once the batcher is closed.
+        """
+        first = self._requests.get()
+        if first is None:
+            return None
+        batch = [first] if first[1].set_running_or_notify_cancel() else []
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self._requests.get(timeout=remaining) if remaining > 0 else self._requests.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._requests.put(None)
+                break
+            if item[1].set_running_or_notify_cancel():
+                batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            if not batch:
+                continue
+            rows, futures = zip(*batch)
+            self.batch_sizes.append(len(rows))
+            # Malformed rows fail their batch like prediction errors, rather than stopping the thread
+            try:
+                if isinstance(rows[0], dict):
+                    frame = pd.DataFrame(list(rows), columns=self.features)
+                else:
+                    frame = pd.DataFrame(np.asarray(rows, dtype=object), columns=self.features)
+                predictions = self.predict_fn(frame)
+                if len(predictions) != len(futures):
+                    raise ValueError(f'predict_fn returned {len(predictions)} predictions for {len(futures)} rows')
+            except Exception as error:
+                for future in futures:
+                    future.set_exception(error)
+                continue
+            for future, prediction in zip(futures, predictions):
+                future.set_result(prediction)
+
+    def close(self):
+        """
+        Scores the requests already queued and stops the background thread.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._requests.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_batcher(path, model='rf_best_model', mmap_mode='r', **batcher_kwargs):
+    """
+    Creates a micro-batcher serving a model saved by TradingPredictor.save_models.
+
+    Parameters:
+        path (str): The file written by save_models.
+        model (str): 'rf_best_model' or 'gb_best_model'.
+        mmap_mode (str): The memory-mapping mode of large plain arrays in the file, None to read them into memory.
+        **batcher_kwargs: The max_batch_size and max_wait of the batcher.
+
+    Returns:
+        MicroBatcher: The running batcher; close it when done.
+    """
+    from TradingPredictor import load_models
+
+    saved = load_models(path, mmap_mode=mmap_mode)
+    features = saved['numerical_features'] + saved['categorical_features']
+    return MicroBatcher(saved[model].predict, features, **batcher_kwargs)
+
+
+def _synthetic_model(n_rows=5000, seed=0):
+    """
+    Fits a TradingPredictor-shaped random forest pipeline on synthetic data.
+    """
+    from sklearn.compose import ColumnTransformer
+    from sklearn.ensemble import RandomForestRegressor
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+    rng = np.random.default_rng(seed)
+    numerical = ['esg_metric_1', 'esg_metric_2', 'non_esg_metric_1', 'non_esg_metric_2']
+    categorical = ['region', 'industry']
+    data = pd.DataFrame(rng.normal(size=(n_rows, len(numerical))), columns=numerical)
+    data['region'] = rng.choice(['EU', 'US', 'APAC'], n_rows)
+    data['industry'] = rng.choice(['energy', 'utilities', 'materials'], n_rows)
+    target = 2 * data['esg_metric_1'] - data['non_esg_metric_2'] + rng.normal(size=n_rows)
+    model = Pipeline([
+        ('preprocessing', ColumnTransformer([
+            ('num', StandardScaler(), numerical),
+            ('cat', OneHotEncoder(), categorical)
+        ])),
+        ('model', RandomForestRegressor(n_estimators=100, max_depth=10, random_state=seed))
+    ]).fit(data, target)
+    return model, data
+
+
+def benchmark(model=None, rows=None, batch_sizes=(1, 8, 32, 128), n_requests=2000, concurrency=64,
+              max_wait=0.002):
+    """
+    Measures request latency and throughput of the micro-batcher for several maximum batch sizes.
+
+    Parameters:
+        model: A fitted pipeline, defaults to a random forest fitted on synthetic TradingPredictor-shaped data.
+        rows (pandas DataFrame): The rows to send, cycled through; defaults to the synthetic training data.
+        batch_sizes (tuple of int): The maximum batch sizes to measure.
+        n_requests (int): The number of single-row requests sent for each batch size.
+        concurrency (int): The number of callers sending requests at the same time.
+        max_wait (float): The batching window in seconds.
+
+    Returns:
+        pandas DataFrame: The p50 and p99 latency in milliseconds, rows per second and mean batch size for each
+        maximum batch size.
+    """
+    if model is None:
+        model, synthetic_rows = _synthetic_model()
+        rows = synthetic_rows if rows is None else rows
+    records = rows.to_dict('records')
+    results = []
+    for batch_size in batch_sizes:
+        latencies = np.empty(n_requests)
+        with MicroBatcher(model.predict, rows.columns, max_batch_size=batch_size, max_wait=max_wait) as batcher:
+            def send(i):
+                start = time.perf_counter()
+                batcher.predict(records[i % len(records)])
+                latencies[i] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as clients:
+                list(clients.map(send, range(n_requests)))
+            elapsed = time.perf_counter() - start
+        results.append({
+            'max_batch_size': batch_size,
+            'p50_ms': np.percentile(latencies, 50) * 1000,
+            'p99_ms': np.percentile(latencies, 99) * 1000,
+            'rows_per_second': n_requests / elapsed,
+            'mean_batch_size': np.mean(batcher.batch_sizes)
+        })
+    return pd.DataFrame(results).set_index('max_batch_size')
+
+
+if __name__ == '__main__':
+    print(benchmark())
@@ -0,0 +1,263 @@
+"""
+A local cache of adjusted close prices with incremental, multi-ticker loading.
+
+Each ticker is cached as one compact .npy file holding its trading days and adjusted closes as two rows; the file
+name records the ticker and the date range the cache covers. A load only asks the provider for the parts of the
+requested range that are not covered yet, merges them in and rewrites the file, so repeated runs work offline and
+never download the same history twice.
+"""
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, unquote
+
+import numpy as np
+import pandas as pd
+
+from Instrumentation import profiled
+
+SEPARATOR = '__'
+ONE_DAY = np.timedelta64(1, 'D')
+
+
+def _day(value):
+    return np.datetime64(pd.Timestamp(value).date(), 'D')
+
+
+class YahooProvider:
+    """
+    Fetches adjusted closes from Yahoo Finance with pandas-datareader.
+    """
+
+    def fetch(self, ticker, start, end):
+        """
+        Returns the adjusted closes of a ticker between two dates, inclusive, as a date-indexed Series.
+        """
+        import pandas_datareader as pdr
+
+        prices = pdr.get_data_yahoo(ticker, start=pd.Timestamp(start), end=pd.Timestamp(end))
+        return prices['Adj Close'].dropna()
+
+
+class FileProvider:
+    """
+    Serves adjusted closes from one CSV file per ticker, standing in for the remote source in tests and offline runs.
+
+    Each file is named <ticker>.csv and has 'date' and 'adj_close' columns. Every fetch is recorded in calls, so
+    tests can check which ranges were requested.
+    """
+
+    def __init__(self, directory):
+        """
+        Parameters:
+            directory (str): The directory holding the CSV files.
+        """
+        self.directory = directory
+        self.calls = []
+
+    @staticmethod
+    def write(directory, prices):
+        """
+        Writes a wide DataFrame of adjusted closes, one column per ticker, as provider files.
+        """
+        os.makedirs(directory, exist_ok=True)
+        for ticker in prices.columns:
+            series = prices[ticker].dropna()
+            pd.DataFrame({'date': series.index, 'adj_close': series.to_numpy()}).to_csv(
+                os.path.join(directory, f'{ticker}.csv'), index=False)
+
+    def fetch(self, ticker, start, end):
+        """
+        Returns the adjusted closes of a ticker between two dates, inclusive, as a date-indexed Series.
+        """
+        self.calls.append((ticker, _day(start), _day(end)))
+        path = os.path.join(self.directory, f'{ticker}.csv')
+        if not os.path.exists(path):
+            raise KeyError(f'no prices for ticker {ticker!r} in {self.directory}')
+        data = pd.read_csv(path, parse_dates=['date']).set_index('date')['adj_close']
+        return data.loc[pd.Timestamp(start):pd.Timestamp(end)]
+
+
+class PriceLoader:
+    """
+    Loads aligned adjusted closes and returns for many tickers through the on-disk cache.
+    """
+
+    def __init__(self, provider=None, root='.pricecache', max_workers=8):
+        """
+        Parameters:
+            provider: The source of prices, an object with a fetch(ticker, start, end) method returning a
+                date-indexed Series. Defaults to YahooProvider.
+            root (str): The cache directory.
+            max_workers (int): The number of tickers fetched at the same time.
+        """
+        self.provider = provider if provider is not None else YahooProvider()
+        self.root = root
+        self.max_workers = max_workers
+
+    def _index(self):
+        """
+        Maps each cached ticker to its cache file and covered date range, from a single directory listing.
+        """
+        if not os.path.isdir(self.root):
+            return {}
+        index = {}
+        for filename in os.listdir(self.root):
+            parts = filename[:-len('.npy')].split(SEPARATOR) if filename.endswith('.npy') else []
+            if len(parts) == 3:
+                index[unquote(parts[0])] = (filename, np.datetime64(parts[1], 'D'), np.datetime64(parts[2], 'D'))
+        return index
+
+    def _read(self, filename):
+        data = np.load(os.path.join(self.root, filename))
+        return data[0].astype('datetime64[D]'), data[1]
+
+    def _write(self, ticker, dates, closes, first, last, previous=None):
+        os.makedirs(self.root, exist_ok=True)
+        filename = f"{quote(ticker, safe='^-.')}{SEPARATOR}{first}{SEPARATOR}{last}.npy"
+        # Days since the epoch are exact in float64, so dates and closes share one compact array
+        data = np.vstack([dates.astype('int64').astype(float), closes])
+        handle, staging = tempfile.mkstemp(suffix='.tmp', dir=self.root)
+        with os.fdopen(handle, 'wb') as f:
+            np.save(f, data)
+        os.replace(staging, os.path.join(self.root, filename))
+        if previous is not None and previous != filename:
+            os.remove(os.path.join(self.root, previous))
+
+    def cached_range(self, ticker):
+        """
+        Returns the first and last day covered by the cache for a ticker, or None if it is not cached.
+        """
+        entry = self._index().get(ticker)
+        return None if entry is None else (entry[1], entry[2])
+
+    def _update(self, ticker, start, end, entry):
+        """
+        Fetches the parts of [start, end] not covered by the cache entry of a ticker and rewrites its cache file.
+        """
+        if entry is None:
+            missing = [(start, end)]
+            dates, closes = np.empty(0, dtype='datetime64[D]'), np.empty(0)
+            first, last = start, end
+        else:
+            filename, first, last = entry
+            # Fetch any gap too, so that each ticker covers one contiguous range
+            missing = [(start, first - ONE_DAY)] if start < first else []
+            missing += [(last + ONE_DAY, end)] if end > last else []
+            if not missing:
+                return
+            dates, closes = self._read(filename)
+            first, last = min(first, start), max(last, end)
+        pieces_dates, pieces_closes = [dates], [closes]
+        for lo, hi in missing:
+            fetched = self.provider.fetch(ticker, lo, hi)
+            fetched_dates = fetched.index.to_numpy().astype('datetime64[D]')
+            keep = (fetched_dates >= lo) & (fetched_dates <= hi)
+            pieces_dates.append(fetched_dates[keep])
+            pieces_closes.append(fetched.to_numpy(dtype=float)[keep])
+        dates, closes = np.concatenate(pieces_dates), np.concatenate(pieces_closes)
+        order = np.argsort(dates, kind='stable')
+        self._write(ticker, dates[order], closes[order], first, last, None if entry is None else entry[0])
+
+    def update(self, tickers, start, end):
+        """
+        Brings the cache of every ticker up to date for a date range, fetching only what is missing.
+
+        The covered range never extends past yesterday, so today's partial data is fetched again on the next run.
+        """
+        start = _day(start)
+        end = min(_day(end), _day(pd.Timestamp.today()) - ONE_DAY)
+        if end < start:
+            return
+        index = self._index()
+        stale = [ticker for ticker in tickers if ticker not in index or
+                 start < index[ticker][1] or end > index[ticker][2]]
+        if not stale:
+            return
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(stale))) as pool:
+            list(pool.map(lambda ticker: self._update(ticker, start, end, index.get(ticker)), stale))
+
+    def prices(self, tickers, start, end, fetch=True):
+        """
+        Loads the adjusted closes of several tickers as a wide DataFrame aligned on the union of their dates.
+
+        Parameters:
+            tickers (list of str): The tickers.
+            start (str or Timestamp): The first date, inclusive.
+            end (str or Timestamp): The last date, inclusive.
+            fetch (bool): Whether to fetch missing ranges from the provider first; without it only the cache is
+                read and tickers that are not cached are left out.
+
+        Returns:
+            pandas DataFrame: The adjusted closes, one column per ticker, NaN where a ticker has no price.
+        """
+        tickers = list(tickers)
+        if fetch:
+            self.update(tickers, start, end)
+        start, end = _day(start), _day(end)
+        index = self._index()
+        columns, series = [], []
+        for ticker in tickers:
+            if ticker in index:
+                dates, closes = self._read(index[ticker][0])
+                lo, hi = np.searchsorted(dates, start, 'left'), np.searchsorted(dates, end, 'right')
+                columns.append(ticker)
+                series.append((dates[lo:hi], closes[lo:hi]))
+        if not series:
+            return pd.DataFrame(columns=tickers, index=pd.DatetimeIndex([], name='date'), dtype=float)
+
+        all_dates = np.unique(np.concatenate([dates for dates, _ in series]))
+        matrix = np.full((len(all_dates), len(series)), np.nan)
+        for j, (dates, closes) in enumerate(series):
+            matrix[np.searchsorted(all_dates, dates), j] = closes
+        return pd.DataFrame(matrix, columns=columns,
+                            index=pd.DatetimeIndex(all_dates.astype('datetime64[ns]'), name='date'))
+
+    @profiled
+    def returns(self, tickers, start, end, fetch=True, dropna=True):
+        """
+        Loads daily simple returns of several tickers as a wide aligned matrix, ready for mean and covariance.
+
+        Parameters:
+            tickers (list of str): The tickers.
+            start (str or Timestamp): The first date, inclusive.
+            end (str or Timestamp): The last date, inclusive.
+            fetch (bool): Whether to fetch missing ranges from the provider first.
+            dropna (bool): Whether to drop the dates on which any ticker has no return.
+
+        Returns:
+            pandas DataFrame: The returns, one column per ticker.
+        """
+        prices = self.prices(tickers, start, end, fetch=fetch)
+        values = prices.to_numpy()
+        returns = pd.DataFrame(values[1:] / values[:-1] - 1, index=prices.index[1:], columns=prices.columns)
+        return returns.dropna() if dropna else returns
+
+
+def benchmark(n_tickers=500, n_days=3000, seed=0):
+    """
+    Times a cold load through a FileProvider and a cached load of a returns matrix for many tickers.
+
+    Returns:
+        dict: The seconds taken by the cold and cached loads, and the shape of the returns matrix.
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2010-01-01', periods=n_days, name='date')
+    prices = pd.DataFrame(100 * np.exp(np.cumsum(rng.normal(0, 0.01, (n_days, n_tickers)), axis=0)),
+                          index=dates, columns=[f'T{i:04d}' for i in range(n_tickers)])
+    with tempfile.TemporaryDirectory() as directory:
+        FileProvider.write(os.path.join(directory, 'source'), prices)
+        loader = PriceLoader(FileProvider(os.path.join(directory, 'source')), root=os.path.join(directory, 'cache'))
+        start = time.perf_counter()
+        loader.returns(prices.columns, dates[0], dates[-1])
+        cold = time.perf_counter() - start
+        start = time.perf_counter()
+        returns = loader.returns(prices.columns, dates[0], dates[-1])
+        cached = time.perf_counter() - start
+    return {'cold_seconds': cold, 'cached_seconds': cached, 'shape': returns.shape,
+            'provider_calls': len(loader.provider.calls)}
+
+
+if __name__ == '__main__':
+    print(benchmark())
@@ -0,0 +1,276 @@
+"""
+A columnar, memory-mapped store for the CSV price and fundamentals histories.
+
+Each CSV is converted once into one NumPy .npy file per column, partitioned by date, with a JSON manifest of the
+columns and partitions. Loads memory-map only the partitions and columns a job asks for, so a date range inside a
+single partition is returned without copying, and the CSV is only parsed again when it changes.
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from Instrumentation import profiled
+
+MANIFEST = 'manifest.json'
+PARTITION_UNITS = {'Y': 'datetime64[Y]', 'M': 'datetime64[M]', 'D': 'datetime64[D]'}
+
+
+class PriceStore:
+    """
+    A directory of converted tables, one sub-directory per table.
+    """
+
+    def __init__(self, root='.pricestore'):
+        """
+        Parameters:
+            root (str): The directory holding the converted tables.
+        """
+        self.root = root
+
+    def _table_dir(self, name):
+        return os.path.join(self.root, name)
+
+    def manifest(self, name):
+        """
+        Returns the manifest of a converted table, or None if it has not been converted.
+        """
+        path = os.path.join(self._table_dir(name), MANIFEST)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def is_current(self, name, csv_path):
+        """
+        Checks whether a table was converted from the current version of a CSV file.
+        """
+        manifest = self.manifest(name)
+        if manifest is None:
+            return False
+        stat = os.stat(csv_path)
+        return manifest['source'] == {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+    def convert(self, csv_path, name=None, date_column='date', partition='M'):
+        """
+        Converts a CSV file into a partitioned columnar table.
+
+        Parameters:
+            csv_path (str): The CSV file to convert.
+            name (str): The name of the table, defaults to the file name without its extension.
+            date_column (str): The column holding the dates, None for tables without one.
+            partition (str): The partition size: 'Y', 'M' or 'D'. Ignored without a date column.
+
+        Returns:
+            str: The name of the table.
+        """
+        name = name or os.path.splitext(os.path.basename(csv_path))[0]
+        stat = os.stat(csv_path)
+        df = pd.read_csv(csv_path)
+        if date_column is not None:
+            df[date_column] = pd.to_datetime(df[date_column])
+            df = df.sort_values(date_column, kind='stable', ignore_index=True)
+            dates = df[date_column].to_numpy(dtype='datetime64[ns]')
+            keys = dates.astype(PARTITION_UNITS[partition])
+            unique_keys, starts = np.unique(keys, return_index=True)
+            bounds = list(zip(starts, list(starts[1:]) + [len(df)]))
+            labels = [str(key) for key in unique_keys]
+        else:
+            bounds = [(0, len(df))]
+            labels = ['all']
+
+        # Typed columns: strings become fixed-width unicode so they can be memory-mapped too
+        columns = {}
+        for column in df.columns:
+            values = df[column].to_numpy()
+            if values.dtype == object:
+                values = values.astype(str)
+            columns[column] = values
+
+        os.makedirs(self.root, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=f'.{name}-', dir=self.root)
+        partitions = []
+        for label, (start, end) in zip(labels, bounds):
+            os.makedirs(os.path.join(staging, label))
+            for column, values in columns.items():
+                np.save(os.path.join(staging, label, column + '.npy'), values[start:end])
+            partition_info = {'key': label, 'rows': int(end - start)}
+            if date_column is not None:
+                partition_info['first'] = str(dates[start])
+                partition_info['last'] = str(dates[end - 1])
+            partitions.append(partition_info)
+        manifest = {
+            'date_column': date_column,
+            'columns': {column: values.dtype.str for column, values in columns.items()},
+            'partitions': partitions,
+            'source': {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+        }
+        with open(os.path.join(staging, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=1)
+
+        target = self._table_dir(name)
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        os.replace(staging, target)
+        return name
+
+    def load(self, name, columns=None, start=None, end=None, index=True):
+        """
+        Loads the columns of a table between two dates.
+
+        Only the partitions overlapping the date range are opened, as read-only-on-disk memory maps (writes go to
+        private copies). A range inside a single partition is returned without copying any data.
+
+        Parameters:
+            name (str): The name of the table.
+            columns (list of str): The columns to load, defaults to all of them.
+            start (str or Timestamp): The first date to load, inclusive.
+            end (str or Timestamp): The last date to load, inclusive.
+            index (bool): Whether to index the result by the date column.
+
+        Returns:
+            pandas DataFrame: The selected rows and columns.
+        """
+        manifest = self.manifest(name)
+        if manifest is None:
+            raise FileNotFoundError(f'table {name!r} has not been converted into {self.root}')
+        date_column = manifest['date_column']
+        if columns is None:
+            columns = [column for column in manifest['columns'] if not (index and column == date_column)]
+        unknown = set(columns) - set(manifest['columns'])
+        if unknown:
+            raise KeyError(f'unknown columns {sorted(unknown)} in table {name!r}')
+        if (start is not None or end is not None) and date_column is None:
+            raise ValueError(f'table {name!r} has no date column to select a range on')
+
+        start = None if start is None else np.datetime64(pd.Timestamp(start), 'ns')
+        end = None if end is None else np.datetime64(pd.Timestamp(end), 'ns')
+        partitions = [p for p in manifest['partitions'] if p['rows'] and
+                      (start is None or np.datetime64(p['last'], 'ns') >= start) and
+                      (end is None or np.datetime64(p['first'], 'ns') <= end)]
+
+        needed = list(columns)
+        if date_column is not None and date_column not in needed and (index or start is not None or
+                                                                       end is not None):
+            needed.append(date_column)
+        pieces = {column: [] for column in needed}
+        for partition in partitions:
+            directory = os.path.join(self._table_dir(name), partition['key'])
+            arrays = {column: np.load(os.path.join(directory, column + '.npy'), mmap_mode='c')
+                      for column in needed}
+            rows = slice(None)
+            if date_column is not None and (start is not None or end is not None):
+                dates = arrays[date_column]
+                lo = 0 if start is None else np.searchsorted(dates, start, side='left')
+                hi = len(dates) if end is None else np.searchsorted(dates, end, side='right')
+                rows = slice(lo, hi)
+            for column in needed:
+                pieces[column].append(arrays[column][rows])
+
+        data = {}
+        for column in needed:
+            if len(pieces[column]) == 1:
+                data[column] = pieces[column][0]
+            elif pieces[column]:
+                data[column] = np.concatenate(pieces[column])
+            else:
+                data[column] = np.empty(0, dtype=np.dtype(manifest['columns'][column]))
+
+        frame_index = None
+        if index and date_column is not None:
+            frame_index = pd.DatetimeIndex(data[date_column], copy=False, name=date_column)
+        return pd.DataFrame({column: data[column] for column in columns}, index=frame_index, copy=False)
+
+
+@profiled
+def read_table(csv_path, columns=None, start=None, end=None, date_column='date', index=True, partition='M',
+               store=None):
+    """
+    Reads a CSV file through the columnar store, converting it first if it is new or has changed.
+
+    This is a drop-in replacement for pd.read_csv followed by pd.to_datetime and set_index on the date column.
+
+    Parameters:
+        csv_path (str): The CSV file.
+        columns (list of str): The columns to load, defaults to all of them.
+        start (str or Timestamp): The first date to load, inclusive.
+        end (str or Timestamp): The last date to load, inclusive.
+        date_column (str): The column holding the dates, None for tables without one.
+        index (bool): Whether to index the result by the date column.
+        partition (str): The partition size used when converting: 'Y', 'M' or 'D'.
+        store (PriceStore): The store to use, defaults to a '.pricestore' directory next to the CSV file.
+
+    Returns:
+        pandas DataFrame: The selected rows and columns.
+    """
+    if store is None:
+        store = PriceStore(os.path.join(os.path.dirname(os.path.abspath(csv_path)), '.pricestore'))
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    if not store.is_current(name, csv_path):
+        store.convert(csv_path, name=name, date_column=date_column, partition=partition)
+    return store.load(name, columns=columns, start=start, end=end, index=index)
+
+
+_MEASURE = '''
+import json, sys, time
+sys.path.insert(0, {repo!r})
+{setup}
+start = time.perf_counter()
+{load}
+elapsed = time.perf_counter() - start
+with open('/proc/self/status') as f:
+    peak_kb = next(int(line.split()[1]) for line in f if line.startswith('VmHWM'))
+print(json.dumps({{'seconds': elapsed, 'peak_rss_mb': peak_kb / 1024, 'rows': len(data)}}))
+'''
+
+
+def benchmark(n_rows=2000000, seed=0):
+    """
+    Compares the CSV path with the columnar store on a synthetic minute-level price history.
+
+    Each load runs in a fresh interpreter so its load time (excluding imports) and peak resident memory are
+    measured in isolation. Peak memory is read from /proc, so the benchmark needs Linux.
+
+    Returns:
+        pandas DataFrame: The load time, peak RSS and rows loaded of each approach.
+    """
+    rng = np.random.default_rng(seed)
+    repo = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = os.path.join(directory, 'gas_prices.csv')
+        pd.DataFrame({
+            'date': pd.date_range('2015-01-01', periods=n_rows, freq='min'),
+            'price': 3.0 + np.cumsum(rng.normal(scale=0.001, size=n_rows)),
+            'volume': rng.integers(100, 10000, size=n_rows)
+        }).to_csv(csv_path, index=False)
+        start = time.perf_counter()
+        read_table(csv_path)
+        conversion = time.perf_counter() - start
+        last_month = pd.Timestamp('2015-01-01') + pd.Timedelta(minutes=n_rows) - pd.DateOffset(months=1)
+
+        loads = {
+            'csv': ('import pandas as pd',
+                    f"data = pd.read_csv({csv_path!r})\n"
+                    "data['date'] = pd.to_datetime(data['date'])\n"
+                    "data = data.set_index('date')"),
+            'store_full': ('from PriceStore import read_table',
+                           f"data = read_table({csv_path!r})"),
+            'store_last_month_price': ('from PriceStore import read_table',
+                                       f"data = read_table({csv_path!r}, columns=['price'], "
+                                       f"start={str(last_month)!r})")
+        }
+        rows = []
+        for label, (setup, load) in loads.items():
+            code = _MEASURE.format(repo=repo, setup=setup, load=load)
+            output = subprocess.run([sys.executable, '-c', code],
+                                    capture_output=True, text=True, check=True).stdout
+            rows.append(dict(json.loads(output), method=label))
+    results = pd.DataFrame(rows).set_index('method')
+    results.attrs['conversion_seconds'] = conversion
+    return results
@@ -0,0 +1,137 @@
+"""
+Constant-time rolling statistics for streaming price data.
+"""
+import math
+
+import numpy as np
+
+
+class RollingWindow:
+    """
+    A fixed-size rolling mean and standard deviation updated one value at a time.
+
+    Values are kept in a ring buffer and the mean and sum of squared deviations are maintained with Welford's
+    update, extended to remove the value leaving the window, so each push costs O(1) time and the memory is
+    bounded by the window size. The statistics are recomputed from the buffer every resync_every pushes to stop
+    rounding errors from accumulating over long streams.
+    """
+
+    def __init__(self, size, resync_every=10000):
+        """
+        Parameters:
+            size (int): The number of values in the window.
+            resync_every (int): The number of pushes between exact recomputations of the statistics.
+        """
+        if size < 2:
+            raise ValueError('window size must be at least 2')
+        self.size = size
+        self.resync_every = max(resync_every, size)
+        self.buffer = np.empty(size)
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self._pos = 0
+        self._pushes = 0
+
+    def push(self, value):
+        """
+        Adds a value to the window, evicting the oldest one once the window is full.
+        """
+        value = float(value)
+        if self.count < self.size:
+            # Plain Welford update while the window fills up
+            self.count += 1
+            delta = value - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (value - self.mean)
+        else:
+            # Replace the oldest value in a single step
+            old = self.buffer[self._pos]
+            old_mean = self.mean
+            self.mean += (value - old) / self.size
+            self.m2 += (value - old) * (value - self.mean + old - old_mean)
+            if self.m2 < 0.0:
+                self.m2 = 0.0
+        self.buffer[self._pos] = value
+        self._pos = (self._pos + 1) % self.size
+        self._pushes += 1
+        if self._pushes % self.resync_every == 0:
+            self._resync()
+
+    def _resync(self):
+        values = self.buffer[:self.count]
+        self.mean = values.mean()
+        self.m2 = ((values - self.mean) ** 2).sum()
+
+    @property
+    def full(self):
+        return self.count == self.size
+
+    @property
+    def variance(self):
+        """
+        The sample variance (ddof=1) of the values in the window.
+        """
+        if self.count < 2:
+            return math.nan
+        return self.m2 / (self.count - 1)
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+
+class StreamingZScore:
+    """
+    The streaming form of the rolling z-score signal used by the gas trading strategies.
+
+    Each call to on_tick updates the rolling window with the new price and returns the signal for that tick in
+    constant time and memory. The signal matches the one computed by a pandas rolling window over the full
+    history.
+    """
+
+    def __init__(self, window=10, threshold=0.2, trade_amount=1000):
+        """
+        Parameters:
+            window (int): The moving average / standard deviation window.
+            threshold (float): The z-score beyond which the strategy buys or sells.
+            trade_amount (float): The amount traded on a BUY or SELL signal.
+        """
+        self.window = RollingWindow(window)
+        self.threshold = threshold
+        self.trade_amount = trade_amount
+        self.last_ts = None
+        self.last_z_score = math.nan
+
+    def update(self, price):
+        """
+        Adds a price to the window and returns its z-score, NaN until the window is full.
+        """
+        self.window.push(price)
+        z_score = math.nan
+        if self.window.full:
+            std = self.window.std
+            if std > 0:
+                z_score = (price - self.window.mean) / std
+        self.last_z_score = z_score
+        return z_score
+
+    def on_tick(self, ts, price):
+        """
+        Processes a new tick and returns its signal.
+
+        Parameters:
+            ts: The timestamp of the tick.
+            price (float): The traded price.
+
+        Returns:
+            tuple: The signal ('BUY', 'SELL' or 'HOLD') and the amount to trade.
+        """
+        self.last_ts = ts
+        z_score = self.update(price)
+        if z_score < -self.threshold:
+            return 'BUY', self.trade_amount
+        elif z_score > self.threshold:
+            return 'SELL', self.trade_amount
+        else:
+            return 'HOLD', 0
@@ -0,0 +1,188 @@
+"""
+Parameter sweeps for the AlgoGasDesk z-score strategy.
+
+Every (ma_period, threshold, trade_amount) combination is backtested with the vectorized engine from AlgoGasDesk.
+Combinations are grouped by ma_period so each worker computes the rolling z-score of a window length once and
+reuses it for every threshold, and the trade amount only rescales the PnL of a unit position. The price array is
+placed in shared memory so worker processes read it without pickling the DataFrame.
+"""
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from AlgoGasDesk import rolling_zscore, zscore_signals, signal_positions
+from Instrumentation import profiled, stage
+
+# Worker-side state, set up once per process by _init_worker
+_prices = None
+_shm = None
+_zscores = {}
+
+
+def _init_worker(shm_name, n_prices):
+    global _prices, _shm
+    _shm = shared_memory.SharedMemory(name=shm_name)
+    _prices = np.ndarray((n_prices,), dtype=np.float64, buffer=_shm.buf)
+    _zscores.clear()
+
+
+def _zscore(ma_period):
+    # Rolling statistics are shared between every combination with the same ma_period
+    if ma_period not in _zscores:
+        _zscores.clear()
+        _zscores[ma_period] = rolling_zscore(_prices, ma_period)
+    return _zscores[ma_period]
+
+
+def _evaluate(task):
+    """
+    Backtests one ma_period against a batch of thresholds and trade amounts.
+    """
+    ma_period, thresholds, trade_amounts, initial_capital, periods_per_year = task
+    prices = _prices
+    z_score = _zscore(ma_period)
+    price_changes = np.diff(prices, prepend=prices[0])
+    rows = []
+    for threshold in thresholds:
+        # Simulate a unit position once; the trade amount only scales it
+        unit_positions = signal_positions(zscore_signals(z_score, threshold), 1.0)
+        unit_pnl = np.concatenate(([0.0], unit_positions[:-1] * price_changes[1:]))
+        unit_equity = np.cumsum(unit_pnl)
+        unit_turnover = np.abs(np.diff(unit_positions, prepend=0.0)).sum()
+        n_trades = int(np.count_nonzero(np.diff(unit_positions, prepend=0.0)))
+        for trade_amount in trade_amounts:
+            equity = initial_capital + trade_amount * unit_equity
+            previous = np.concatenate(([initial_capital], equity[:-1]))
+            returns = trade_amount * unit_pnl / previous
+            std = returns.std(ddof=1) if len(returns) > 1 else 0.0
+            sharpe = returns.mean() / std * np.sqrt(periods_per_year) if std > 0 else 0.0
+            peak = np.maximum.accumulate(np.concatenate(([initial_capital], equity)))[1:]
+            drawdown = ((peak - equity) / peak).max()
+            rows.append((ma_period, threshold, trade_amount, sharpe, drawdown, trade_amount * unit_turnover,
+                         n_trades, equity[-1]))
+    return rows
+
+
+def _release_worker():
+    global _prices, _shm
+    _prices = None
+    _zscores.clear()
+    if _shm is not None:
+        _shm.close()
+        _shm = None
+
+
+def _tasks(ma_periods, thresholds, trade_amounts, initial_capital, periods_per_year, chunk_size):
+    for ma_period in ma_periods:
+        for start in range(0, len(thresholds), chunk_size):
+            yield (ma_period, thresholds[start:start + chunk_size], trade_amounts, initial_capital,
+                   periods_per_year)
+
+
+@profiled
+def sweep(data, ma_periods, thresholds, trade_amounts, initial_capital=10000, periods_per_year=252,
+          max_workers=None, chunk_size=None):
+    """
+    Evaluates every combination of strategy parameters and ranks them by Sharpe ratio.
+
+    Parameters:
+        data (pandas DataFrame or array-like): The price history, either a DataFrame with a 'price' column or the
+            prices themselves.
+        ma_periods (iterable of int): The moving average windows to try.
+        thresholds (iterable of float): The z-score thresholds to try.
+        trade_amounts (iterable of float): The trade amounts to try.
+        initial_capital (float): The starting portfolio value.
+        periods_per_year (int): The number of bars per year, used to annualize the Sharpe ratio.
+        max_workers (int): The number of worker processes, defaults to the number of CPUs. With 1 the sweep runs
+            in the calling process.
+        chunk_size (int): The number of thresholds evaluated per task, defaults to an even split over the workers.
+
+    Returns:
+        pandas DataFrame: One row per combination with its Sharpe ratio, maximum drawdown, turnover, number of
+        trades and final portfolio value, best Sharpe first.
+    """
+    prices = data['price'] if isinstance(data, pd.DataFrame) else data
+    prices = np.ascontiguousarray(prices, dtype=np.float64)
+    ma_periods = sorted(set(int(p) for p in ma_periods))
+    thresholds = [float(t) for t in thresholds]
+    trade_amounts = [float(a) for a in trade_amounts]
+    # Check the inputs before the shared memory is allocated
+    if len(prices) == 0:
+        raise ValueError('the price history is empty')
+    for name, values in (('ma_periods', ma_periods), ('thresholds', thresholds), ('trade_amounts', trade_amounts)):
+        if not values:
+            raise ValueError(f'{name} must not be empty')
+    max_workers = max_workers or os.cpu_count() or 1
+    if chunk_size is None:
+        tasks_per_period = max(1, -(-2 * max_workers // len(ma_periods)))
+        chunk_size = max(1, -(-len(thresholds) // tasks_per_period))
+    tasks = _tasks(ma_periods, thresholds, trade_amounts, initial_capital, periods_per_year, chunk_size)
+
+    shm = shared_memory.SharedMemory(create=True, size=max(prices.nbytes, 1))
+    try:
+        np.ndarray(prices.shape, dtype=np.float64, buffer=shm.buf)[:] = prices
+        if max_workers == 1:
+            _init_worker(shm.name, len(prices))
+            try:
+                results = [_evaluate(task) for task in tasks]
+            finally:
+                _release_worker()
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                     initargs=(shm.name, len(prices))) as executor:
+                results = list(executor.map(_evaluate, tasks))
+    finally:
+        shm.close()
+        shm.unlink()
+
+    results = pd.DataFrame(list(itertools.chain.from_iterable(results)),
+                           columns=['ma_period', 'threshold', 'trade_amount', 'sharpe', 'max_drawdown',
+                                    'turnover', 'n_trades', 'final_value'])
+    results = results.sort_values(['sharpe', 'max_drawdown'], ascending=[False, True], ignore_index=True)
+    results.index = pd.RangeIndex(1, len(results) + 1, name='rank')
+    return results
+
+
+def benchmark(n_bars=20000, n_thresholds=50, worker_counts=(1, 2, 4), seed=0):
+    """
+    Times a sweep of 5 ma_periods x n_thresholds x 4 trade amounts on a synthetic random walk for several worker
+    counts.
+
+    Returns:
+        pandas DataFrame: The wall time, combinations per second and speedup over one worker for each worker count.
+    """
+    rng = np.random.default_rng(seed)
+    prices = 3.0 + np.cumsum(rng.normal(scale=0.01, size=n_bars))
+    grid = ([10, 20, 30, 50, 100], np.linspace(0.5, 3.0, n_thresholds), [500, 1000, 2000, 5000])
+    n_combinations = len(grid[0]) * len(grid[1]) * len(grid[2])
+    rows = []
+    for workers in worker_counts:
+        start = time.perf_counter()
+        sweep(prices, *grid, max_workers=workers)
+        elapsed = time.perf_counter() - start
+        rows.append((workers, elapsed, n_combinations / elapsed))
+    timings = pd.DataFrame(rows, columns=['workers', 'seconds', 'combinations_per_second'])
+    timings['speedup'] = timings['seconds'].iloc[0] / timings['seconds']
+    return timings
+
+
+def main(path='gas_prices.csv'):
+    from AlgoGasDesk import load_data
+
+    # Sweep the strategy parameters over the historical gas prices and print the best combinations
+    with stage('data_load'):
+        data = load_data(path)
+    with stage('optimize'):
+        results = sweep(data, ma_periods=range(5, 55, 5), thresholds=np.arange(0.5, 3.05, 0.1),
+                        trade_amounts=[500, 1000, 2000])
+    print(results.head(20))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+Seeded synthetic inputs for every TradeDesk workload, in the shapes and files the scripts read.
+
+Each generator takes a size and a seed and returns the same data for the same arguments, so benchmark runs on
+different machines or commits see identical inputs. write_dataset writes the files the scripts expect by default
+(gas_prices.csv, mydatabase.db, trading_data.db, supply_demand_data.csv, price_data.csv and storage_data.csv) into a
+directory.
+"""
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+from GasNetwork import synthetic_grid
+
+# The size of every input at each scale
+SIZES = {
+    'small': {'n_bars': 5000, 'n_esg_rows': 20000, 'n_trading_rows': 500, 'n_periods': 120, 'n_assets': 50,
+              'n_return_periods': 500, 'n_risk_assets': 20, 'n_scenarios': 100000, 'storage_periods': 365,
+              'n_facilities': 1, 'grid': (10, 10)},
+    'medium': {'n_bars': 100000, 'n_esg_rows': 500000, 'n_trading_rows': 2000, 'n_periods': 1000, 'n_assets': 200,
+               'n_return_periods': 1500, 'n_risk_assets': 50, 'n_scenarios': 1000000, 'storage_periods': 8760,
+               'n_facilities': 1, 'grid': (30, 30)},
+    'large': {'n_bars': 2000000, 'n_esg_rows': 5000000, 'n_trading_rows': 10000, 'n_periods': 10000,
+              'n_assets': 500, 'n_return_periods': 2500, 'n_risk_assets': 100, 'n_scenarios': 2000000,
+              'storage_periods': 8760, 'n_facilities': 10, 'grid': (60, 60)},
+}
+
+NUMERICAL_FEATURES = ['esg_metric_1', 'esg_metric_2', 'non_esg_metric_1', 'non_esg_metric_2']
+CATEGORICAL_FEATURES = ['region', 'industry']
+TARGET = 'trading_performance'
+
+
+def gas_prices(n_bars, seed=0):
+    """
+    Hourly gas prices and volumes: a mean-reverting log price with daily seasonality and fat-tailed shocks.
+
+    Returns:
+        pandas DataFrame: The 'price' and 'volume' columns, indexed by 'date'.
+    """
+    rng = np.random.default_rng(seed)
+    shocks = rng.standard_t(4, n_bars) * 0.004
+    # The log price deviation is an AR(1) around log(3) with a half-life of about 700 bars
+    log_price = np.log(3.0) + lfilter([1.0], [1.0, -0.999], shocks)
+    hours = np.arange(n_bars) % 24
+    price = np.exp(log_price) * (1 + 0.02 * np.sin(2 * np.pi * hours / 24))
+    volume = rng.gamma(2.0, 500.0, n_bars) * (1 + np.abs(shocks) * 50)
+    index = pd.date_range('2015-01-01', periods=n_bars, freq='h', name='date')
+    return pd.DataFrame({'price': price, 'volume': volume.round()}, index=index)
+
+
+def esg_performance(n_rows, seed=0, n_times=250):
+    """
+    ESG and non-ESG performance records with the duplicate rows and missing values DataAnalyzer cleans.
+
+    Returns:
+        pandas DataFrame: The 'performance_type', 'time' and 'performance_value' columns.
+    """
+    rng = np.random.default_rng(seed)
+    performance_type = np.where(rng.random(n_rows) < 0.5, 'ESG', 'Non-ESG')
+    time = rng.integers(0, n_times, n_rows)
+    value = rng.normal(0.05, 0.2, n_rows) + np.where(performance_type == 'ESG', 0.01, 0.0)
+    values = value.round(6).astype(object)
+    values[rng.random(n_rows) < 0.001] = None
+    frame = pd.DataFrame({'performance_type': performance_type, 'time': time, 'performance_value': values})
+    duplicates = frame.sample(frac=0.01, random_state=seed)
+    return pd.concat([frame, duplicates], ignore_index=True)
+
+
+def trading_data(n_rows, seed=0):
+    """
+    Trading performance driven by ESG and non-ESG metrics, regions and industries, in TradingPredictor's columns.
+
+    Returns:
+        pandas DataFrame: The numerical and categorical features and the target.
+    """
+    rng = np.random.default_rng(seed)
+    frame = pd.DataFrame(rng.normal(size=(n_rows, len(NUMERICAL_FEATURES))), columns=NUMERICAL_FEATURES)
+    frame['region'] = rng.choice(['EU', 'US', 'APAC'], n_rows)
+    frame['industry'] = rng.choice(['energy', 'utilities', 'materials'], n_rows)
+    region_effect = frame['region'].map({'EU': 0.2, 'US': 0.0, 'APAC': -0.1})
+    frame[TARGET] = (2 * frame['esg_metric_1'] - frame['non_esg_metric_2'] + 0.5 * frame['esg_metric_2'] ** 2 +
+                     region_effect + rng.normal(size=n_rows))
+    return frame
+
+
+def write_sqlite(frame, path, table):
+    """
+    Writes a DataFrame as a table of a SQLite database, replacing the table if it exists.
+    """
+    connection = sqlite3.connect(path)
+    try:
+        frame.to_sql(table, connection, index=False, if_exists='replace', chunksize=100000)
+    finally:
+        connection.close()
+    return path
+
+
+def energy_frames(n_periods, seed=0):
+    """
+    The supply and demand, price and storage histories EnergyAnalytics reads.
+
+    Returns:
+        dict: The 'supply_demand', 'price' and 'storage' DataFrames.
+    """
+    rng = np.random.default_rng(seed)
+    season = np.cos(2 * np.pi * np.arange(n_periods) / 52)
+    demand = 100 + 20 * season + np.cumsum(rng.normal(0, 1, n_periods))
+    supply = demand + rng.normal(0, 3, n_periods)
+    storage = 500 + np.cumsum(supply - demand)
+    price = 3 - 0.02 * (supply - demand) + 0.001 * (storage - 500) + rng.normal(0, 0.1, n_periods)
+    return {
+        'supply_demand': pd.DataFrame({'supply': supply, 'demand': demand}),
+        'price': pd.DataFrame({'supply': supply, 'demand': demand, 'storage': storage, 'price': price}),
+        'storage': pd.DataFrame({'start_storage': [storage[0]], 'end_storage': [storage[-1]]}),
+    }
+
+
+def returns_matrix(n_periods, n_assets, n_factors=5, seed=0):
+    """
+    Daily asset returns from a factor model with specific noise.
+
+    Returns:
+        pandas DataFrame: The returns, one column per asset.
+    """
+    rng = np.random.default_rng(seed)
+    loadings = rng.normal(0, 1, (n_assets, n_factors))
+    factors = rng.normal(0.0003, 0.006, (n_periods, n_factors))
+    returns = factors @ loadings.T + rng.normal(0, 0.01, (n_periods, n_assets)) + rng.normal(0.0002, 0.0002, n_assets)
+    index = pd.bdate_range('2015-01-01', periods=n_periods, name='date')
+    return pd.DataFrame(returns, index=index, columns=[f'A{i:04d}' for i in range(n_assets)])
+
+
+def storage_prices(n_periods, n_facilities=1, seed=0):
+    """
+    Seasonal prices for storage dispatch, one row per facility.
+    """
+    rng = np.random.default_rng(seed)
+    season = np.cos(2 * np.pi * np.arange(n_periods) / n_periods)
+    return 3.0 + season + rng.normal(0, 0.2, (n_facilities, n_periods))
+
+
+def gas_network(n_rows, n_cols, seed=0):
+    """
+    A random grid pipeline network, as GasNetwork.synthetic_grid.
+    """
+    return synthetic_grid(n_rows, n_cols, seed=seed)
+
+
+def write_dataset(directory, size='small', seed=0):
+    """
+    Writes the files the scripts read by default into a directory.
+
+    Parameters:
+        directory (str): The target directory, created if needed.
+        size (str): 'small', 'medium' or 'large'.
+        seed (int): The random seed.
+
+    Returns:
+        dict: The path of each file.
+    """
+    sizes = SIZES[size]
+    os.makedirs(directory, exist_ok=True)
+    paths = {name: os.path.join(directory, filename) for name, filename in (
+        ('gas_prices', 'gas_prices.csv'), ('esg', 'mydatabase.db'), ('trading', 'trading_data.db'),
+        ('supply_demand', 'supply_demand_data.csv'), ('price', 'price_data.csv'), ('storage', 'storage_data.csv'))}
+    gas_prices(sizes['n_bars'], seed).to_csv(paths['gas_prices'])
+    write_sqlite(esg_performance(sizes['n_esg_rows'], seed), paths['esg'], 'mytable')
+    write_sqlite(trading_data(sizes['n_trading_rows'], seed), paths['trading'], 'trading_table')
+    for name, frame in energy_frames(sizes['n_periods'], seed).items():
+        frame.to_csv(paths[name], index=False)
+    return paths
@@ -1,9 +1,18 @@
-from data_analyzer import DataAnalyzer
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import joblib
+from joblib import Memory, effective_n_jobs
+from DataAnalyzer import DataAnalyzer
+from Instrumentation import profiled, stage
+from sklearn.base import clone
 from sklearn.pipeline import Pipeline
 from sklearn.compose import ColumnTransformer
 from sklearn.preprocessing import StandardScaler, OneHotEncoder
 from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor
-from sklearn.model_selection import GridSearchCV, cross_val_score
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.model_selection import GridSearchCV, HalvingGridSearchCV, cross_val_score
 from sklearn.metrics import mean_squared_error
 
 
@@ -48,25 +57,78 @@ class TradingPredictor:
         """
         self.analyzer.clean_data()
 
-    def fit_models(self, param_grid):
+    def _make_search(self, pipeline, param_grid, search, n_jobs, memory, **search_kwargs):
+        """
+        Creates the hyperparameter search of one pipeline.
+        """
+        if memory is not None:
+            pipeline = clone(pipeline).set_params(memory=memory)
+        if search == 'grid':
+            return GridSearchCV(pipeline, param_grid, cv=5, scoring='neg_mean_squared_error', n_jobs=n_jobs,
+                                **search_kwargs)
+        elif search == 'halving':
+            return HalvingGridSearchCV(pipeline, param_grid, cv=5, scoring='neg_mean_squared_error', n_jobs=n_jobs,
+                                       **search_kwargs)
+        raise ValueError(f"search must be 'grid' or 'halving', got {search!r}")
+
+    @profiled
+    def fit_models(self, param_grid, n_jobs=-1, concurrent=True, search='grid', cache_dir=None, **search_kwargs):
         """
         Fits the random forest and gradient boosting models to the data.
 
         Parameters:
             param_grid (dict): A dictionary of hyperparameters to search over for each model.
+            n_jobs (int): The number of processes of the searches, -1 for all cores.
+            concurrent (bool): Whether to run the random forest and gradient boosting searches at the same time,
+                each with half of the n_jobs processes (at least one).
+            search (str): 'grid' for an exhaustive grid search, or 'halving' for a successive-halving search that
+                discards poor candidates on small subsets of the data before fitting the rest on all of it.
+            cache_dir (str or bool): A directory in which the pipelines cache the fitted preprocessing of each
+                cross-validation fold, so it is fitted once per fold instead of once per candidate and fold.
+                True uses a temporary directory removed after the search. None disables the cache.
+            **search_kwargs: Extra arguments of the search class, e.g. factor or min_resources for 'halving'.
         """
-        rf_cv = GridSearchCV(self.rf_pipeline, param_grid, cv=5, scoring='neg_mean_squared_error')
-        rf_cv.fit(self.analyzer.df[self.numerical_features + self.categorical_features], self.analyzer.df[self.target])
-        self.rf_best_model = rf_cv.best_estimator_
+        X = self.analyzer.df[self.numerical_features + self.categorical_features]
+        y = self.analyzer.df[self.target]
+
+        temporary_dir = tempfile.mkdtemp(prefix='tradingpredictor-') if cache_dir is True else None
+        memory = Memory(temporary_dir or cache_dir, verbose=0) if cache_dir else None
+        # Concurrent searches share the processes rather than each starting a pool of n_jobs of them
+        per_search = max(1, effective_n_jobs(n_jobs) // 2) if concurrent else n_jobs
+        try:
+            rf_cv = self._make_search(self.rf_pipeline, param_grid, search, per_search, memory, **search_kwargs)
+            gb_cv = self._make_search(self.gb_pipeline, param_grid, search, per_search, memory, **search_kwargs)
+            if concurrent:
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    for future in [executor.submit(rf_cv.fit, X, y), executor.submit(gb_cv.fit, X, y)]:
+                        future.result()
+            else:
+                rf_cv.fit(X, y)
+                gb_cv.fit(X, y)
+        finally:
+            if temporary_dir is not None:
+                shutil.rmtree(temporary_dir, ignore_errors=True)
 
-        gb_cv = GridSearchCV(self.gb_pipeline, param_grid, cv=5, scoring='neg_mean_squared_error')
-        gb_cv.fit(self.analyzer.df[self.numerical_features + self.categorical_features], self.analyzer.df[self.target])
+        self.rf_search = rf_cv
+        self.rf_best_model = rf_cv.best_estimator_
+        self.gb_search = gb_cv
         self.gb_best_model = gb_cv.best_estimator_
 
-    def evaluate_models(self):
+    @profiled
+    def evaluate_models(self, reuse_search=True):
         """
         Evaluates the performance of the random forest and gradient boosting models using cross-validation.
+
+        Parameters:
+            reuse_search (bool): Whether to take the cross-validated score of the best candidate from the search
+                instead of cross-validating the best models again. The search already scored them on the same 5
+                folds, so this avoids refitting each model 5 more times.
         """
+        if reuse_search and hasattr(self, 'rf_search') and hasattr(self, 'gb_search'):
+            self.rf_rmse = (-self.rf_search.best_score_)**0.5
+            self.gb_rmse = (-self.gb_search.best_score_)**0.5
+            return
+
         rf_scores = cross_val_score(self.rf_best_model,
                                     self.analyzer.df[self.numerical_features + self.categorical_features],
                                     self.analyzer.df[self.target],
@@ -82,29 +144,70 @@ class TradingPredictor:
         
         self.gb_rmse = (-gb_scores.mean())**0.5
 
-        
-if __name__ == '__main__':
-    # Set up database and input variables
-    db_file = 'trading_data.db'
-    table_name = 'trading_table'
+    def save_models(self, path):
+        """
+        Saves the best random forest and gradient boosting models with the feature lists they expect.
+
+        The file is written uncompressed so load_models can memory-map its large plain arrays.
+
+        Parameters:
+            path (str): The file to write.
+        """
+        joblib.dump({
+            'rf_best_model': self.rf_best_model,
+            'gb_best_model': self.gb_best_model,
+            'numerical_features': self.numerical_features,
+            'categorical_features': self.categorical_features,
+            'target': self.target
+        }, path)
+
+
+def load_models(path, mmap_mode='r'):
+    """
+    Loads models saved by TradingPredictor.save_models without refitting them.
+
+    With mmap_mode='r' only large plain NumPy arrays in the file are memory-mapped rather than read. The tree
+    ensembles themselves are rebuilt when unpickled, which copies their node arrays, so every process that loads
+    the file holds its own copy of the fitted trees.
+
+    Parameters:
+        path (str): The file written by save_models.
+        mmap_mode (str): The memory-mapping mode passed to joblib.load, None to read everything into memory.
+
+    Returns:
+        dict: The models under 'rf_best_model' and 'gb_best_model', and the feature lists and target name.
+    """
+    return joblib.load(path, mmap_mode=mmap_mode)
+
+
+def main(db_file='trading_data.db', table_name='trading_table', param_grid=None, **fit_kwargs):
+    # Set up input variables
     numerical_features = ['esg_metric_1', 'esg_metric_2', 'non_esg_metric_1', 'non_esg_metric_2']
     categorical_features = ['region', 'industry']
     target = 'trading_performance'
 
     # Create predictor object and clean the data
-    predictor = TradingPredictor(db_file, table_name, numerical_features, categorical_features, target)
-    predictor.clean_data()
+    with stage('data_load'):
+        predictor = TradingPredictor(db_file, table_name, numerical_features, categorical_features, target)
+        predictor.clean_data()
 
     # Set up a parameter grid for grid search
-    param_grid = {
-        'model__n_estimators': [50, 100, 200],
-        'model__max_depth': [5, 10, 20]
-    }
+    if param_grid is None:
+        param_grid = {
+            'model__n_estimators': [50, 100, 200],
+            'model__max_depth': [5, 10, 20]
+        }
 
     # Fit models using grid search and evaluate their performance
-    predictor.fit_models(param_grid)
-    predictor.evaluate_models()
+    with stage('model_fit'):
+        predictor.fit_models(param_grid, **fit_kwargs)
+        predictor.evaluate_models()
 
     # Print the root mean squared error of the random forest and gradient boosting models
     print(f'Random forest RMSE: {predictor.rf_rmse}')
     print(f'Gradient boosting RMSE: {predictor.gb_rmse}')
+    return predictor
+
+
+if __name__ == '__main__':
+    main()